@@ -0,0 +1,130 @@
+import os
+import queue
+import shutil
+import threading
+import torch
+from base.exceptions import ProjectException
+
+
+def snapshot(obj):
+    """
+    Copy of (nested) state with every tensor copied to cpu, so training can continue while it is written.
+    Tensors are saved in default memory layout, see BaseModel.save
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True).contiguous()
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def write_checkpoint(data, path):
+    """
+    torch.save to temporary file which replaces path. Existing file is never written in place,
+    so hard links to it (see link_checkpoint) keep their content
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = "%s.tmp%s" % (path, os.getpid())
+    torch.save(data, temporary)
+    os.replace(temporary, path)
+
+
+def link_checkpoint(path, link_path):
+    """
+    Make link_path refer to content of path: hard link, or copy if linking is impossible.
+    Safe as long as checkpoints are written with write_checkpoint only
+    """
+    temporary = "%s.tmp%s" % (link_path, os.getpid())
+    try:
+        os.link(path, temporary)
+    except OSError:
+        # e.g. other file system
+        shutil.copyfile(path, temporary)
+    os.replace(temporary, link_path)
+
+
+class CheckpointManager:
+    """
+    Writes checkpoints on background thread. Every file is written to temporary file and renamed,
+    so readers never see partially written checkpoint. Checkpoints of one group (e.g. one fold of one config)
+    are ranked by `metric` of their scores and only the best `keep` of them stay on disk.
+    Best checkpoint of group is hard linked (copied if linking is impossible) instead of copied.
+    At most `max_pending` snapshots wait for writing, training waits for the writer beyond that
+    """
+    def __init__(self, keep=3, metric="val_loss", mode="min", max_pending=2):
+        if mode not in ("min", "max"):
+            raise ProjectException("Unknown mode %s. Use one of (min, max)" % mode)
+        self.keep = keep
+        self.metric = metric
+        self.mode = mode
+        self._groups = {}
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._work, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def __getstate__(self):
+        # queue and thread are not sent to other processes, each of them starts its own writer
+        return {"keep": self.keep, "metric": self.metric, "mode": self.mode, "max_pending": self._queue.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def save(self, data, path, group, best_path=None):
+        """
+        :param data: checkpoint dict, see BaseModel.save. Its tensors are copied before this method returns
+        :param group: hashable key, checkpoints of the same group (e.g. one fold of one config) compete for
+                      `keep` places
+        :param best_path: where to link this checkpoint if it is the best one, nothing is linked if None
+        """
+        self._raise_error()
+        # checkpoint which cannot be ranked is rejected here, before anything is written
+        score = self._score(data)
+        self._queue.put((snapshot(data), path, group, best_path, score))
+
+    def _score(self, data):
+        scores = data.get("scores") or {}
+        if self.metric not in scores:
+            raise ProjectException("Checkpoint has no %s score to rank it" % self.metric)
+        score = float(scores[self.metric])
+        return score if self.mode == "min" else -score
+
+    def _retain(self, path, group, score):
+        # returns True if checkpoint is the best of its group
+        ranked = [(s, p) for s, p in self._groups.get(group, []) if p != path]
+        ranked.append((score, path))
+        ranked.sort(key=lambda item: item[0])
+        for _, removed in ranked[self.keep:]:
+            if os.path.isfile(removed):
+                os.unlink(removed)
+        self._groups[group] = ranked[:self.keep]
+        return ranked[0][1] == path
+
+    def _work(self):
+        while True:
+            data, path, group, best_path, score = self._queue.get()
+            try:
+                write_checkpoint(data, path)
+                is_best = self._retain(path, group, score)
+                if is_best and best_path is not None:
+                    link_checkpoint(path, best_path)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise ProjectException("Checkpoint was not written: %s" % error)
+
+    def flush(self):
+        """
+        Wait until all queued checkpoints are on disk
+        """
+        self._queue.join()
+        self._raise_error()
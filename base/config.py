@@ -1,6 +1,6 @@
 import os
 import errno
-from tensorboardX import SummaryWriter
+from base.lazy import LazyAttribute
 
 
 class ProjectConfig:
@@ -12,7 +12,9 @@ class ProjectConfig:
     fold_directory = os.path.join(data_directory, "folds")
     vis_directory = os.path.join(data_directory, "vis")
     orig_data_directory = os.path.join(data_directory, "orig")
-    logger_class = SummaryWriter
+    store_directory = os.path.join(data_directory, "store")
+    cache_directory = os.path.join(data_directory, "cache")
+    logger_class = LazyAttribute("tensorboardX", "SummaryWriter")
 
     @classmethod
     def combine(cls, base_path, *pathes):
@@ -38,6 +40,8 @@ class ProjectConfig:
             cls._make_dir(name)
         cls._make_dir(cls.vis_directory)
         cls._make_dir(cls.orig_data_directory)
+        cls._make_dir(cls.store_directory)
+        cls._make_dir(cls.cache_directory)
         cls._make_dir(cls.model_directory)
 
 
@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 
@@ -26,6 +27,25 @@ class DummyDataset(BaseDataset):
         return item
 
 
+class ArrayDataset(BaseDataset):
+    """
+    Items are rows of (possibly memory mapped) arrays of inputs and targets
+    """
+    def __init__(self, inputs, targets, transform=None):
+        self.inputs = inputs
+        self.targets = targets
+        self.transform = transform
+
+    def __len__(self):
+        return self.inputs.shape[0]
+
+    def __getitem__(self, idx):
+        item = {"inputs": np.array(self.inputs[idx]), "targets": np.array([self.targets[idx]])}
+        if self.transform:
+            item = self.transform(item)
+        return item
+
+
 class ToTensor:
     def __init__(self, excluded_keys=("id",)):
         self.excluded = excluded_keys
@@ -0,0 +1,186 @@
+import os
+import time
+import struct
+import socket
+import atexit
+import weakref
+import itertools
+import threading
+
+
+def _make_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC_TABLE = _make_crc_table()
+
+
+def crc32c(data):
+    crc = 0xFFFFFFFF
+    table = _CRC_TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+# minimal protobuf wire format encoding of tensorflow Event, Summary and HistogramProto messages
+def _varint(value):
+    if value < 0:
+        value += 1 << 64
+    result = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            result.append(bits | 0x80)
+        else:
+            result.append(bits)
+            return bytes(result)
+
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+
+def _int_field(field, value):
+    return _key(field, 0) + _varint(int(value))
+
+
+def _double_field(field, value):
+    return _key(field, 1) + struct.pack("<d", value)
+
+
+def _float_field(field, value):
+    return _key(field, 5) + struct.pack("<f", value)
+
+
+def _bytes_field(field, value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return _key(field, 2) + _varint(len(value)) + value
+
+
+def _packed_doubles_field(field, values):
+    return _bytes_field(field, struct.pack("<%sd" % len(values), *values))
+
+
+def scalar_value(tag, value):
+    # Summary.Value: tag = 1, simple_value = 2
+    return _bytes_field(1, tag) + _float_field(2, float(value))
+
+
+def image_value(tag, encoded, height, width, colorspace):
+    # Summary.Image: height = 1, width = 2, colorspace = 3, encoded_image_string = 4; Summary.Value.image = 4
+    image = _int_field(1, height) + _int_field(2, width) + _int_field(3, colorspace) + _bytes_field(4, encoded)
+    return _bytes_field(1, tag) + _bytes_field(4, image)
+
+
+def histogram_value(tag, minimum, maximum, num, total, sum_squares, bucket_limit, bucket):
+    # HistogramProto: min = 1, max = 2, num = 3, sum = 4, sum_squares = 5, bucket_limit = 6, bucket = 7;
+    # Summary.Value.histo = 5
+    histogram = _double_field(1, minimum) + _double_field(2, maximum) + _double_field(3, num) + \
+        _double_field(4, total) + _double_field(5, sum_squares) + \
+        _packed_doubles_field(6, bucket_limit) + _packed_doubles_field(7, bucket)
+    return _bytes_field(1, tag) + _bytes_field(5, histogram)
+
+
+def summary_event(values, step, wall_time=None):
+    # Event: wall_time = 1, step = 2, summary = 5; Summary: repeated value = 1
+    summary = b"".join(_bytes_field(1, v) for v in values)
+    wall_time = time.time() if wall_time is None else wall_time
+    return _double_field(1, wall_time) + _int_field(2, step) + _bytes_field(5, summary)
+
+
+def version_event(wall_time=None):
+    # Event.file_version = 3
+    wall_time = time.time() if wall_time is None else wall_time
+    return _double_field(1, wall_time) + _bytes_field(3, "brain.Event:2")
+
+
+def frame_record(data):
+    """
+    TFRecord framing: length, masked crc32c of length, data, masked crc32c of data
+    """
+    header = struct.pack("<Q", len(data))
+    return header + struct.pack("<I", masked_crc32c(header)) + data + struct.pack("<I", masked_crc32c(data))
+
+
+# writers which are not closed yet, they are closed at interpreter exit. Weak references do not keep
+# writers of finished loggers (and their files) alive
+_OPEN_WRITERS = weakref.WeakSet()
+_FILE_NUMBER = itertools.count()
+
+
+@atexit.register
+def _close_writers():
+    for writer in list(_OPEN_WRITERS):
+        writer.close()
+
+
+class EventFileWriter:
+    """
+    Writes TensorBoard event file without tensorflow. Encoded events are kept in memory and written
+    with one system call when `max_pending` of them are collected, on flush(), close() or at interpreter exit.
+    Every writer has its own file, also writers created in the same second by several processes.
+    All methods can be called from several threads
+    """
+    def __init__(self, log_dir, max_pending=64, filename_suffix=""):
+        os.makedirs(log_dir, exist_ok=True)
+        # time, host, process and number of writer in process, like file names of tensorflow
+        name = "events.out.tfevents.%010d.%s.%s.%s%s" % (time.time(), socket.gethostname(), os.getpid(),
+                                                         next(_FILE_NUMBER), filename_suffix)
+        self.path = os.path.join(log_dir, name)
+        self.max_pending = max_pending
+        self._pending = []
+        self._lock = threading.Lock()
+        self._file = open(self.path, "wb")
+        self.add_event(version_event())
+        self.flush()
+        _OPEN_WRITERS.add(self)
+
+    def add_event(self, event):
+        record = frame_record(event)
+        with self._lock:
+            self._pending.append(record)
+            if len(self._pending) >= self.max_pending:
+                self._write_pending()
+
+    def add_summary(self, values, step):
+        """
+        :param values: list of encoded Summary.Value messages, see scalar_value, image_value and histogram_value
+        """
+        self.add_event(summary_event(values, step))
+
+    def _write_pending(self):
+        if self._pending and self._file is not None:
+            self._file.write(b"".join(self._pending))
+            self._file.flush()
+        self._pending = []
+
+    def flush(self):
+        with self._lock:
+            self._write_pending()
+
+    def close(self):
+        with self._lock:
+            self._write_pending()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        _OPEN_WRITERS.discard(self)
+
+    def __del__(self):
+        # pending events of writer which was not closed are not lost
+        if getattr(self, "_file", None) is not None:
+            self.close()
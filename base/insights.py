@@ -1,12 +1,14 @@
 import torch
 from torch.autograd import Variable
 from torch.autograd import Function
-from torchvision import models
-from torchvision import utils
-import cv2
 import sys
 import numpy as np
 import argparse
+from base.lazy import lazy_import
+
+models = lazy_import("torchvision.models")
+utils = lazy_import("torchvision.utils")
+cv2 = lazy_import("cv2")
 
 
 class FeatureExtractor:
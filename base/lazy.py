@@ -0,0 +1,101 @@
+import re
+import sys
+import types
+import argparse
+import importlib
+import subprocess
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module which is imported on first attribute access. Used for heavy optional dependencies
+    (cv2, sklearn, scipy, matplotlib, torchvision, ...), so entry points pay only for code paths they run
+    """
+    def __init__(self, name):
+        super().__init__(name)
+        self._lazy_name = name
+        self._lazy_module = None
+
+    def _load(self):
+        if self._lazy_module is None:
+            self._lazy_module = importlib.import_module(self._lazy_name)
+        return self._lazy_module
+
+    def __getattr__(self, item):
+        if item.startswith("_lazy_"):
+            raise AttributeError(item)
+        return getattr(self._load(), item)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._lazy_module is not None else "not loaded"
+        return "<lazy module %s (%s)>" % (self._lazy_name, state)
+
+
+def lazy_import(name):
+    """
+    :param name: full module name, e.g. "sklearn.metrics"
+    :return: already imported module or LazyModule importing it on first use
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+class LazyAttribute:
+    """
+    Class attribute which is an object of lazily imported module, e.g. logger_class = LazyAttribute("tensorboardX",
+    "SummaryWriter"). Module is imported when attribute is read for the first time
+    """
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return getattr(importlib.import_module(self.module), self.name)
+
+
+_IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def import_time_report(module, top=15):
+    """
+    Import module in fresh interpreter with -X importtime
+    :return: (total seconds, list of (cumulative seconds, package name) of the slowest packages)
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        print(process.stderr)
+        raise SystemExit("Cannot import %s" % module)
+    entries = []
+    for line in process.stderr.splitlines():
+        match = _IMPORT_TIME.match(line)
+        if match:
+            # nested imports are indented by two spaces per level
+            depth = (len(match.group(3)) - 1) // 2
+            entries.append((int(match.group(2)) / 1e6, depth, match.group(4)))
+    # interpreter startup modules (site, encodings, ...) are counted too, they are part of cold start
+    total = sum(cumulative for cumulative, depth, name in entries if depth == 0)
+    # every module is imported once, so cumulative time of top level package is the cost of pulling it in
+    slowest = sorted(((cumulative, name) for cumulative, depth, name in entries if "." not in name), reverse=True)
+    return total, slowest[:top]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold start import time of module, e.g. python -m base.lazy "
+                                                 "cnn.inference --budget 1.5")
+    parser.add_argument("module")
+    parser.add_argument("--budget", type=float, default=None, help="fail if import takes longer (seconds)")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    total, slowest = import_time_report(args.module, args.top)
+    for seconds, name in slowest:
+        print("%8.3f s  %s" % (seconds, name))
+    print("Import of %s took %.3f s" % (args.module, total))
+    if args.budget is not None and total > args.budget:
+        print("Budget of %.3f s is exceeded!" % args.budget)
+        sys.exit(1)
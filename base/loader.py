@@ -0,0 +1,71 @@
+import torch
+import random
+import numpy as np
+from torch.utils.data import DataLoader, TensorDataset, Subset
+
+
+def seed_worker(worker_id):
+    """
+    worker_init_fn for DataLoader. Forked workers inherit the same numpy and random state,
+    so each of them is reseeded from its own torch seed (base seed of the epoch + worker id)
+    """
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+class InMemoryLoader:
+    """
+    Replacement of DataLoader for datasets which fit in memory. Inputs and targets are preloaded to two tensors,
+    batches are sliced out of them by shuffled index blocks, so there are no worker processes,
+    no per item dictionaries and no collation. Augmentation is applied to whole batch by batch_transform.
+    Yields the same {"inputs", "targets"} batches as DataLoader with default collate
+    """
+    def __init__(self, inputs, targets, batch_size, shuffle=False, indices=None, batch_transform=None,
+                 drop_last=False, generator=None):
+        self.inputs = inputs
+        self.targets = targets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        if indices is None:
+            indices = torch.arange(inputs.size(0))
+        self.indices = torch.as_tensor(indices, dtype=torch.long)
+        self.batch_transform = batch_transform
+        self.drop_last = drop_last
+        self.generator = generator
+        self.dataset = Subset(TensorDataset(inputs, targets), self.indices.tolist())
+
+    @classmethod
+    def preload(cls, dataset, batch_size=512, use_gpu=True):
+        """
+        Read all items of dataset once. Per item transforms of dataset must be deterministic (e.g. ToTensor),
+        they are not applied again
+        :return: (inputs, targets) tensors, on gpu if it is available
+        """
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+        inputs, targets = [], []
+        for batch in loader:
+            inputs.append(batch["inputs"])
+            targets.append(batch["targets"])
+        inputs, targets = torch.cat(inputs), torch.cat(targets)
+        if torch.cuda.is_available() and use_gpu:
+            inputs, targets = inputs.cuda(), targets.cuda()
+        return inputs, targets
+
+    def __len__(self):
+        length = self.indices.size(0)
+        if self.drop_last:
+            return length // self.batch_size
+        return (length + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(indices.size(0), generator=self.generator)]
+        indices = indices.to(self.inputs.device)
+        for i in range(len(self)):
+            block = indices[i * self.batch_size: (i + 1) * self.batch_size]
+            batch = {"inputs": self.inputs.index_select(0, block), "targets": self.targets.index_select(0, block)}
+            if self.batch_transform is not None:
+                batch = self.batch_transform(batch)
+            yield batch
@@ -1,9 +1,14 @@
-import six
-import tensorflow as tf
 import numpy as np
-import scipy.misc
 import os
+import queue
 import shutil
+import threading
+import torch
+from base.exceptions import ProjectException
+from base.event_writer import EventFileWriter, scalar_value, image_value, histogram_value
+from base.lazy import lazy_import
+
+cv2 = lazy_import("cv2")
 
 
 class Logger(object):
@@ -11,7 +16,7 @@ class Logger(object):
         """Create a summary writer logging to log_dir."""
         if erase_folder_content:
             self._empty_folder(log_dir)
-        self.writer = tf.summary.FileWriter(log_dir)
+        self.writer = EventFileWriter(log_dir)
         self._log_dir = log_dir
 
     @classmethod
@@ -28,56 +33,115 @@ class Logger(object):
 
     def scalar_summary(self, tag, value, step):
         """Log a scalar variable."""
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)])
-        self.writer.add_summary(summary, step)
+        self.writer.add_summary([scalar_value(tag, value)], step)
+
+    @classmethod
+    def _encode_png(cls, img):
+        # float images are scaled to 0..255 the same way as scipy.misc.toimage did
+        if img.dtype != np.uint8:
+            low, high = float(np.min(img)), float(np.max(img))
+            scale = 255.0 / (high - low) if high > low else 1.0
+            img = np.clip((img - low) * scale + 0.4999, 0, 255).astype(np.uint8)
+        success, encoded = cv2.imencode(".png", img)
+        if not success:
+            raise ProjectException("Cannot encode image of shape %s" % (img.shape,))
+        return encoded.tobytes()
 
     def image_summary(self, tag, images, step):
         """Log a list of images."""
 
         img_summaries = []
         for i, img in enumerate(images):
-            # Write the image to a string
-            # if image_order == "nchw":
-            #     img = np.transpose(img, (1, 2, 0))
-
-            s = six.BytesIO()
-            scipy.misc.toimage(img).save(s, format="png")
+            # channels of color images are in opencv (BGR) order
+            channels = img.shape[2] if img.ndim == 3 else 1
+            img_summaries.append(image_value('%s/%d' % (tag, i), self._encode_png(img),
+                                             height=img.shape[0], width=img.shape[1], colorspace=channels))
+        self.writer.add_summary(img_summaries, step)
 
-            # Create an Image object
-            img_sum = tf.Summary.Image(encoded_image_string=s.getvalue(),
-                                       height=img.shape[0],
-                                       width=img.shape[1])
-            # Create a Summary value
-            img_summaries.append(tf.Summary.Value(tag='%s/%d' % (tag, i), image=img_sum))
+    def flush(self):
+        self.writer.flush()
 
-        # Create and write Summary
-        summary = tf.Summary(value=img_summaries)
-        self.writer.add_summary(summary, step)
+    def close(self):
+        """Write pending events and close event file. Logger cannot be used after that"""
+        self.writer.close()
 
-    def histo_summary(self, tag, values, step, bins=1000):
-        """Log a histogram of the tensor of values."""
+    def histo_summary(self, tag, values, step, bins=1000, flush=True):
+        """Log a histogram of the tensor of values. Many histograms can be written with flush=False and one flush()"""
 
         # Create a histogram using numpy
         counts, bin_edges = np.histogram(values, bins=bins)
 
-        # Fill the fields of the histogram proto
-        hist = tf.HistogramProto()
-        hist.min = float(np.min(values))
-        hist.max = float(np.max(values))
-        hist.num = int(np.prod(values.shape))
-        hist.sum = float(np.sum(values))
-        hist.sum_squares = float(np.sum(values ** 2))
-
         # Drop the start of the first bin
-        bin_edges = bin_edges[1:]
+        histogram = histogram_value(tag, minimum=float(np.min(values)), maximum=float(np.max(values)),
+                                    num=float(np.prod(values.shape)), total=float(np.sum(values)),
+                                    sum_squares=float(np.sum(values ** 2)),
+                                    bucket_limit=bin_edges[1:].tolist(), bucket=counts.tolist())
+        self.writer.add_summary([histogram], step)
+        if flush:
+            self.writer.flush()
 
-        # Add bin edges and counts
-        for edge in bin_edges:
-            hist.bucket_limit.append(edge)
-        for c in counts:
-            hist.bucket.append(c)
 
-        # Create and write Summary
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, histo=hist)])
-        self.writer.add_summary(summary, step)
-        self.writer.flush()
+class AsyncHistogramWriter:
+    """
+    Histograms of weights and gradients built and written by background thread.
+    Training thread only takes snapshot of tensor (copy on its device, optionally random sample of max_values
+    elements) and puts it into bounded queue. When queue is full snapshot is dropped instead of blocking training.
+    Tensors are logged every `every` epochs or optimizer steps, see `unit`
+    """
+    def __init__(self, every=1, unit="epoch", max_queue=256, max_values=None, bins=1000):
+        if unit not in ("epoch", "step"):
+            raise ProjectException("Unknown unit %s. Use one of (epoch, step)" % unit)
+        self.every = every
+        self.unit = unit
+        self.max_values = max_values
+        self.bins = bins
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._work, name="histogram-writer", daemon=True)
+        self._thread.start()
+
+    def __getstate__(self):
+        # queue and thread are not sent to other processes, each of them starts its own writer
+        return {"every": self.every, "unit": self.unit, "max_queue": self._queue.maxsize,
+                "max_values": self.max_values, "bins": self.bins}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def is_due(self, step, unit="epoch"):
+        return unit == self.unit and step % self.every == 0
+
+    def _snapshot(self, tensor):
+        values = tensor.detach().reshape(-1)
+        if self.max_values is not None and values.numel() > self.max_values:
+            # index_select makes a copy as well
+            index = torch.randint(values.numel(), (self.max_values,), device=values.device)
+            return values.index_select(0, index)
+        return values.clone()
+
+    def submit(self, logger, tag, tensor, step):
+        try:
+            self._queue.put_nowait((logger, tag, self._snapshot(tensor), step))
+        except queue.Full:
+            self.dropped += 1
+
+    def _work(self):
+        while True:
+            logger, tag, values, step = self._queue.get()
+            try:
+                logger.histo_summary(tag, values.cpu().numpy(), step, bins=self.bins, flush=False)
+                if self._queue.empty():
+                    logger.flush()
+            except Exception as e:
+                print("Histogram %s was not written: %s" % (tag, e))
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Wait until all queued histograms are written
+        """
+        self._queue.join()
+        if self.dropped:
+            print("%s histograms were dropped, logging is slower than training" % self.dropped)
+            self.dropped = 0
@@ -0,0 +1,130 @@
+import numpy as np
+import torch
+
+
+class PredictionAccumulator:
+    """
+    Typed buffers for per sample results of one epoch (targets, probabilities, classes, ...).
+    Buffers are preallocated for expected number of samples and batches are written into them by slice.
+    If more values arrive than expected, buffer grows by doubling
+    """
+    def __init__(self, capacity=1024, dtype=np.float64):
+        self.capacity = max(int(capacity), 1)
+        self.dtype = dtype
+        self._buffers = {}
+        self._counts = {}
+
+    def append(self, key, values):
+        values = np.ravel(np.asarray(values, dtype=self.dtype))
+        if key not in self._buffers:
+            self._buffers[key] = np.empty(self.capacity, dtype=self.dtype)
+            self._counts[key] = 0
+        buffer = self._buffers[key]
+        start = self._counts[key]
+        stop = start + values.shape[0]
+        if stop > buffer.shape[0]:
+            size = buffer.shape[0]
+            while size < stop:
+                size *= 2
+            grown = np.empty(size, dtype=self.dtype)
+            grown[:start] = buffer[:start]
+            self._buffers[key] = buffer = grown
+        buffer[start: stop] = values
+        self._counts[key] = stop
+        return self
+
+    def __getitem__(self, key):
+        if key not in self._buffers:
+            return np.empty(0, dtype=self.dtype)
+        return self._buffers[key][:self._counts[key]]
+
+    def __contains__(self, key):
+        return key in self._buffers
+
+    def keys(self):
+        return self._buffers.keys()
+
+    def pop(self, key):
+        values = self[key]
+        self._buffers.pop(key, None)
+        self._counts.pop(key, None)
+        return values
+
+
+class StreamingBinaryMetrics:
+    """
+    Running metrics of binary classifier kept as tensors on the device of predictions.
+    Batches only add to sums, confusion counts and fixed-bin histograms of scores of both classes,
+    so there is no host synchronisation until compute() at the end of epoch.
+    AUC is approximated from histograms with resolution 1 / bins
+    """
+    def __init__(self, bins=1000, threshold=0.5, eps=1e-7):
+        self.bins = bins
+        self.threshold = threshold
+        self.eps = eps
+        self._state = None
+        self._has_loss = False
+
+    def _init_state(self, device):
+        zeros = torch.zeros(1, dtype=torch.float64, device=device)
+        self._state = {
+            "count": zeros.clone(), "loss": zeros.clone(), "log_loss": zeros.clone(),
+            "tp": zeros.clone(), "fp": zeros.clone(), "tn": zeros.clone(), "fn": zeros.clone(),
+            "positive": torch.zeros(self.bins, dtype=torch.float64, device=device),
+            "negative": torch.zeros(self.bins, dtype=torch.float64, device=device),
+        }
+
+    def update(self, probs, targets, loss=None):
+        """
+        :param probs: tensor of predicted probabilities of positive class
+        :param targets: tensor of 0 / 1 labels of the same number of elements
+        :param loss: mean loss of batch (tensor), optional
+        """
+        probs = probs.detach().reshape(-1).double()
+        targets = targets.detach().reshape(-1).double()
+        if self._state is None:
+            self._init_state(probs.device)
+        state = self._state
+        size = probs.size(0)
+        state["count"] += size
+        if loss is not None:
+            state["loss"] += loss.detach().double().reshape(-1)[0] * size
+            self._has_loss = True
+        clipped = probs.clamp(self.eps, 1 - self.eps)
+        state["log_loss"] -= (targets * clipped.log() + (1 - targets) * (1 - clipped).log()).sum()
+
+        predicted = (probs > self.threshold).double()
+        state["tp"] += (predicted * targets).sum()
+        state["fp"] += (predicted * (1 - targets)).sum()
+        state["fn"] += ((1 - predicted) * targets).sum()
+        state["tn"] += ((1 - predicted) * (1 - targets)).sum()
+
+        positions = (probs * self.bins).long().clamp(0, self.bins - 1)
+        state["positive"].index_add_(0, positions, targets)
+        state["negative"].index_add_(0, positions, 1 - targets)
+        return self
+
+    def _auc(self, positive, negative):
+        total_positive, total_negative = positive.sum(), negative.sum()
+        if total_positive == 0 or total_negative == 0:
+            return float("nan")
+        # positives scored above every bin, ties inside of bin count as half
+        above = np.cumsum(positive[::-1])[::-1] - positive
+        return float(((above + positive / 2) * negative).sum() / (total_positive * total_negative))
+
+    def compute(self, prefix=""):
+        if self._state is None:
+            return {}
+        state = {k: v.cpu().numpy() for k, v in self._state.items()}
+        count = max(state["count"][0], 1)
+        tp, fp, tn, fn = state["tp"][0], state["fp"][0], state["tn"][0], state["fn"][0]
+        result = {
+            "acc": (tp + tn) / count,
+            "precision": tp / (tp + fp) if tp + fp else 0.0,
+            "recall": tp / (tp + fn) if tp + fn else 0.0,
+            "log_loss": state["log_loss"][0] / count,
+            "auc": self._auc(state["positive"], state["negative"]),
+        }
+        if self._has_loss:
+            result["loss"] = state["loss"][0] / count
+        return {prefix + k: float(v) for k, v in result.items()}
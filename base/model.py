@@ -1,34 +1,49 @@
+import os
 import abc
-import cv2
 import sys
 import numpy as np
 import torch
 import random
 import torch.nn as nn
-import shutil
-from sklearn import metrics
 from tqdm import tqdm as progressbar
 from torch.autograd import Variable
-from collections import defaultdict
 from pprint import pformat
 from base.exceptions import ProjectException
 from base.config import ProjectConfig
+from base.metrics import PredictionAccumulator, StreamingBinaryMetrics
+from base.lazy import lazy_import
+from base.registry import ARTIFACT_FORMAT, load_artifact
+from base.checkpoint import write_checkpoint, link_checkpoint
+
+cv2 = lazy_import("cv2")
+metrics = lazy_import("sklearn.metrics")
 
 
 class BaseModel(nn.Module):
+    # float32: default NCHW float32 mode, bfloat16: autocast to bfloat16 with channels_last memory format
+    PRECISIONS = ("float32", "bfloat16")
+    # AsyncHistogramWriter, histograms of weights and gradients are written synchronously every epoch if None
+    histogram_writer = None
+    # CheckpointManager, checkpoints of epochs are written synchronously and all of them are kept if None
+    checkpoint_manager = None
+    # key of batch items which are fed to the model, see check_precision
+    _input_key = "inputs"
+
     def __init__(self, pos_params, named_params, seed=10101, model_name=None, best_model_name=""):
         self._best_model_name = best_model_name or ProjectConfig.combine(ProjectConfig.model_directory, "best.mdl")
         self.model_name = model_name
-        self._predictions = defaultdict(list)
+        self._predictions = PredictionAccumulator()
         self._epoch = 0
+        self.precision = "float32"
         torch.manual_seed(seed)
         if torch.cuda.is_available():
             torch.cuda.manual_seed(seed)
         super().__init__()
         self._model_params = {"args": pos_params, "kwargs": named_params}
 
-    def _reset_predictions_cache(self):
-        self._predictions = defaultdict(list)
+    def _reset_predictions_cache(self, capacity=None):
+        # capacity: expected number of samples per epoch, kept from the previous cache by default
+        self._predictions = PredictionAccumulator(capacity or self._predictions.capacity)
 
     @abc.abstractmethod
     def forward(self, *args, **kwargs):
@@ -38,6 +53,58 @@ class BaseModel(nn.Module):
     def predict(self, x, **kwargs):
         pass
 
+    def set_precision(self, precision):
+        if precision not in self.PRECISIONS:
+            raise ProjectException("Unknown precision %s. Use one of %s" % (precision, self.PRECISIONS))
+        memory_format = torch.channels_last if precision == "bfloat16" else torch.contiguous_format
+        self.to(memory_format=memory_format)
+        self.precision = precision
+        return self
+
+    def _forward(self, x):
+        if self.precision == "float32":
+            return self.__call__(x)
+        if x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        device_type = next(self.parameters()).device.type
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            outputs = self.__call__(x)
+        # outputs are cast back, so losses are computed in float32
+        if isinstance(outputs, tuple):
+            return tuple(o.float() for o in outputs)
+        return outputs.float()
+
+    def check_precision(self, loader, precision="bfloat16", max_diff=0.02):
+        """
+        Compare outputs of precision mode with float32 ones on loader, e.g. validation set.
+        Loader must yield batches in the same order every time. Meant for trained or restored models
+        :param max_diff: allowed maximal absolute difference of outputs
+        :return: dict with maximal and mean absolute difference
+        """
+        current = self.precision
+        was_training = self.training
+        self.eval()
+        outputs = {}
+        with torch.no_grad():
+            for mode in ("float32", precision):
+                self.set_precision(mode)
+                results = PredictionAccumulator(len(loader.dataset))
+                for batch in loader:
+                    output = self._forward(self.to_var(batch[self._input_key]))
+                    if isinstance(output, tuple):
+                        output = output[0]
+                    results.append("outputs", self.to_np(output))
+                outputs[mode] = results["outputs"]
+        self.set_precision(current)
+        self.train(was_training)
+        difference = np.abs(outputs["float32"] - outputs[precision])
+        stats = {"max_diff": float(difference.max()), "mean_diff": float(difference.mean())}
+        print("Parity of %s with float32: %s" % (precision, stats))
+        if stats["max_diff"] > max_diff:
+            raise ProjectException("Outputs in %s differ from float32 ones by %s. Keep float32 mode!"
+                                   % (precision, stats["max_diff"]))
+        return stats
+
     @classmethod
     @abc.abstractmethod
     def _get_inputs(cls, iterator):
@@ -75,13 +142,13 @@ class BaseModel(nn.Module):
 
     def _accumulate_results(self, target_y, pred_y, loss=None, **kwargs):
         if loss is not None:
-            self._predictions["train_loss"].append(loss)
+            self._predictions.append("train_loss", loss)
         for k, v in kwargs.items():
-            self._predictions[k].extend(v)
+            self._predictions.append(k, v)
         if target_y is not None:
-            self._predictions["target"].extend(target_y)
+            self._predictions.append("target", target_y)
         if pred_y is not None:
-            self._predictions["predicted"].extend(pred_y)
+            self._predictions.append("predicted", pred_y)
 
     @classmethod
     def show_env_info(cls):
@@ -106,40 +173,87 @@ class BaseModel(nn.Module):
         for tag, value in data_dict.items():
             logger.scalar_summary(tag, value, self._epoch + 1)
 
-    def _log_grads(self, logger):
+    def _log_grads(self, logger, step=None, unit="epoch"):
+        step = self._epoch + 1 if step is None else step
+        writer = self.histogram_writer
+        if writer is None:
+            if unit != "epoch":
+                return
+            for tag, value in self.named_parameters():
+                tag = tag.replace('.', '/')
+                logger.histo_summary(tag, self.to_np(value), step, flush=False)
+                if value.grad is not None:
+                    logger.histo_summary(tag + '/grad', self.to_np(value.grad), step, flush=False)
+            logger.flush()
+            return
+        if not writer.is_due(step, unit):
+            return
         for tag, value in self.named_parameters():
             tag = tag.replace('.', '/')
-            logger.histo_summary(tag, self.to_np(value), self._epoch + 1)
+            writer.submit(logger, tag, value.data, step)
             if value.grad is not None:
-                logger.histo_summary(tag + '/grad', self.to_np(value.grad), self._epoch + 1)
+                writer.submit(logger, tag + '/grad', value.grad.data, step)
+
+    def _log_step(self, logger, epoch, iteration, iter_per_epoch):
+        if self.histogram_writer is not None and self.histogram_writer.unit == "step":
+            self._log_grads(logger, epoch * iter_per_epoch + iteration + 1, unit="step")
+
+    def _flush_writers(self):
+        if self.histogram_writer is not None:
+            self.histogram_writer.flush()
+        if self.checkpoint_manager is not None:
+            self.checkpoint_manager.flush()
 
     def _log_and_reset(self, logger, data, log_grads=True):
         self._log_data(logger, data)
         if log_grads:
             self._log_grads(logger)
 
-    def save(self, path, optimizer, is_best, scores=None):
+    def _get_checkpoint(self, optimizer, scores=None):
         # positional and named params will be used to restore model later
-        data = {
+        return {
             'epoch': self._epoch + 1,
-            'state_dict': self.state_dict(),
+            # channels_last parameters are saved in default layout, so checkpoints restore the same in any mode
+            'state_dict': {k: v.contiguous() for k, v in self.state_dict().items()},
             'optimizer': optimizer.state_dict(),
             'model_params': self._model_params,
             'scores': scores
         }
-        torch.save(data, path)
+
+    def save(self, path, optimizer, is_best, scores=None):
+        # files are replaced, never written in place: best model may be hard linked to checkpoint of an epoch
+        write_checkpoint(self._get_checkpoint(optimizer, scores), path)
         if is_best:
-            shutil.copyfile(path, self._best_model_name)
+            link_checkpoint(path, self._best_model_name)
+
+    def _save_epoch(self, path, optimizer, is_best, scores):
+        # checkpoint of every epoch, written by checkpoint_manager if there is one
+        if self.checkpoint_manager is None:
+            self.save(path, optimizer, is_best, scores=scores)
+            return
+        self.checkpoint_manager.save(self._get_checkpoint(optimizer, scores), path, group=self._checkpoint_group(),
+                                     best_path=self._best_model_name)
+
+    def _checkpoint_group(self):
+        # epochs of one model compete for places of checkpoint_manager. Best model name is not enough,
+        # e.g. all folds of auto encoders share it
+        return self.model_name, getattr(self, "fold_number", None), self._model_params["kwargs"].get("model_prefix")
 
-    def load(self, path):
+    def load(self, path, optimizer=None):
         """
         Load model state from file. Model must be initialised by this moment
         :param path: string path to file containing model
+        :param optimizer: optimizer of this model, its state is restored too to continue training
         :return: instance of this class
         :rtype: BaseModel
         """
-        checkpoint = torch.load(path)
+        if self.checkpoint_manager is not None:
+            self.checkpoint_manager.flush()
+        # training checkpoints are trusted, their scores may be numpy scalars
+        checkpoint = torch.load(path, weights_only=False)
         self.load_state_dict(checkpoint['state_dict'])
+        if optimizer is not None:
+            optimizer.load_state_dict(checkpoint['optimizer'])
         scores = pformat(checkpoint["scores"])
         print("Loading model from epoch %s with scores \n%s" % (checkpoint["epoch"], scores))
         self.eval()
@@ -153,7 +267,7 @@ class BaseModel(nn.Module):
         :return: instance of this class
         :rtype: BaseModel
         """
-        checkpoint = torch.load(path)
+        checkpoint = torch.load(path, weights_only=False)
         epoch = checkpoint["epoch"]
         scores = pformat(checkpoint["scores"])
         model_params = checkpoint["model_params"]
@@ -169,8 +283,60 @@ class BaseModel(nn.Module):
         instance.eval()
         return instance
 
+    @classmethod
+    def export(cls, checkpoint_path, artifact_path, **metadata):
+        """
+        Write inference artifact of training checkpoint: weights, constructor params and metadata,
+        without optimizer state. Artifact is loaded by from_artifact or base.registry.ModelRegistry
+        :param metadata: extra values stored with epoch and scores of checkpoint, e.g. config=...
+        """
+        # training checkpoint is trusted and its scores may be numpy scalars (e.g. of exact_metrics),
+        # weights_only is only used to read artifacts
+        checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+        if checkpoint["model_params"] is None:
+            raise ProjectException("No model params found. Cannot export model!")
+        # artifacts are read with weights_only, so numpy scalars of scores are stored as floats
+        scores = {k: float(v) for k, v in (checkpoint["scores"] or {}).items()}
+        metadata.update({"epoch": checkpoint["epoch"], "scores": scores,
+                         "source": os.path.abspath(checkpoint_path)})
+        artifact = {
+            "format": ARTIFACT_FORMAT,
+            "model_class": "%s.%s" % (cls.__module__, cls.__qualname__),
+            "model_params": checkpoint["model_params"],
+            "metadata": metadata,
+            "state_dict": {k: v.contiguous() for k, v in checkpoint["state_dict"].items()},
+        }
+        temporary = "%s.tmp%s" % (artifact_path, os.getpid())
+        torch.save(artifact, temporary)
+        os.replace(temporary, artifact_path)
+        return artifact_path
+
+    @classmethod
+    def from_artifact(cls, artifact):
+        """
+        Create model for inference from artifact written by export. Parameters are not initialised
+        and not copied: they are assigned the (memory mapped) tensors of artifact
+        :param artifact: path or dict returned by base.registry.load_artifact
+        :rtype: BaseModel
+        """
+        if isinstance(artifact, str):
+            artifact = load_artifact(artifact)
+        if artifact["model_class"].rpartition(".")[2] != cls.__name__:
+            raise ProjectException("Artifact of %s cannot be loaded by %s" % (artifact["model_class"], cls.__name__))
+        params = artifact["model_params"]
+        with torch.device("meta"):
+            instance = cls(*params["args"], **params["kwargs"])
+        instance.load_state_dict(artifact["state_dict"], assign=True)
+        instance.metadata = artifact["metadata"]
+        instance.eval()
+        instance.requires_grad_(False)
+        return instance
+
 
 class BaseBinaryClassifier(BaseModel):
+    # metrics are computed on device from running sums by default, exact mode collects all predictions for sklearn
+    exact_metrics = False
+
     @classmethod
     def _get_classes(cls, predictions):
         classes = (predictions.data > 0.5).float()
@@ -181,8 +347,20 @@ class BaseBinaryClassifier(BaseModel):
     def forward(self, *args, **kwargs):
         pass
 
+    @classmethod
+    def stacked_forward(cls, models, x, sizes=None):
+        """
+        Forward pass of several models of this class at once, see base.stacked.ModelStack
+        :param models: list of K models with parameters of the same shapes
+        :param x: tensor (K, B, ...), batch of every model
+        :param sizes: number of real rows of every batch, the others are padding and must not change
+                      batch statistics (see base.stacked.stacked_batch_norm). All rows are real if None
+        :return: tensor (K, B, num_classes)
+        """
+        raise ProjectException("Model %s cannot be stacked" % cls.__name__)
+
     def predict(self, x, return_classes=False):
-        predictions = self.__call__(x)
+        predictions = self._forward(x)
         classes = None
         if return_classes:
             classes = self._get_classes(predictions)
@@ -213,11 +391,22 @@ class BaseBinaryClassifier(BaseModel):
         return final
 
     def _eval_on_validation(self, loader, loss_fn):
+        if self.exact_metrics:
+            return self._eval_exact(loader, loss_fn)
+        iterator = iter(loader)
+        iter_per_epoch = len(loader)
+        running = StreamingBinaryMetrics()
+        for i in range(iter_per_epoch):
+            inputs, targets = self._get_inputs(iterator)
+            probs, _ = self.predict(inputs)
+            loss = loss_fn(probs, targets).data if loss_fn else None
+            running.update(probs.data, targets.data, loss)
+        return running.compute(prefix="val_")
+
+    def _eval_exact(self, loader, loss_fn):
         iterator = iter(loader)
         iter_per_epoch = len(loader)
-        all_predictions = np.array([])
-        all_targets = np.array([])
-        all_probs = np.array([])
+        results = PredictionAccumulator(len(loader.dataset))
         losses = []
         for i in range(iter_per_epoch):
             inputs, targets = self._get_inputs(iterator)
@@ -227,11 +416,11 @@ class BaseBinaryClassifier(BaseModel):
                 loss = loss_fn(probs, targets)
                 losses.append(loss.data[0])
             probs = self.to_np(probs).squeeze()
-            all_targets = np.append(all_targets, target_y)
-            all_probs = np.append(all_probs, probs)
-            all_predictions = np.append(all_predictions, classes)
-        computed_metrics = self._compute_metrics(all_targets, all_predictions, training=False)
-        computed_metrics_1 = self._compute_metrics(all_targets, all_probs, training=False,
+            results.append("target", target_y)
+            results.append("probs", probs)
+            results.append("predicted", classes)
+        computed_metrics = self._compute_metrics(results["target"], results["predicted"], training=False)
+        computed_metrics_1 = self._compute_metrics(results["target"], results["probs"], training=False,
                                                    predictions_are_classes=False)
 
         val_loss = sum(losses) / len(losses)
@@ -239,8 +428,12 @@ class BaseBinaryClassifier(BaseModel):
         computed_metrics.update(computed_metrics_1)
         return computed_metrics
 
-    def evaluate(self, logger, loader, loss_fn=None, switch_to_eval=True):
+    def _get_train_metrics(self):
         # aggregate results from training epoch.
+        if not self.exact_metrics:
+            train_metrics = self._running.compute()
+            train_metrics["train_loss"] = train_metrics.pop("loss")
+            return train_metrics
         train_losses = self._predictions.pop("train_loss")
         train_loss = sum(train_losses) / len(train_losses)
         train_metrics_1 = self._compute_metrics(self._predictions["target"], self._predictions["predicted"])
@@ -249,6 +442,10 @@ class BaseBinaryClassifier(BaseModel):
         train_metrics = {"train_loss": train_loss}
         train_metrics.update(train_metrics_1)
         train_metrics.update(train_metrics_2)
+        return train_metrics
+
+    def evaluate(self, logger, loader, loss_fn=None, switch_to_eval=True):
+        train_metrics = self._get_train_metrics()
 
         if switch_to_eval:
             self.eval()
@@ -261,11 +458,38 @@ class BaseBinaryClassifier(BaseModel):
         self._log_and_reset(logger, data=computed_metrics, log_grads=False)
 
         self._reset_predictions_cache()
+        self._running = StreamingBinaryMetrics()
         return computed_metrics
 
-    def fit(self, optim, loss_fn, data_loader, validation_data_loader, num_epochs, logger):
+    def _finish_epoch(self, optim, loss_fn, validation_data_loader, logger, best_loss):
+        # evaluate, log and save checkpoint of epoch self._epoch
+        stats = self.evaluate(logger, validation_data_loader, loss_fn, switch_to_eval=True)
+        is_best = stats["val_loss"] < best_loss
+        best_loss = min(best_loss, stats["val_loss"])
+        model_path = ProjectConfig.combine(ProjectConfig.model_directory,
+                                           "%s_%s_fold_%s.mdl" % (self.model_name, str(self._epoch + 1),
+                                                                  self.fold_number))
+        self._save_epoch(model_path, optim, is_best, stats)
+        return stats, best_loss
+
+    def fit(self, optim, loss_fn, data_loader, validation_data_loader, num_epochs, logger, exact_metrics=False,
+            precision="float32", start_epoch=0, epoch_callback=None):
+        """
+        :param exact_metrics: collect all predictions and compute metrics with sklearn (e.g. for final reports)
+                              instead of running on device metrics with histogram approximated auc
+        :param precision: one of PRECISIONS. Other modes than float32 are checked against it on validation set
+                          with trained weights at the end, initial weights give near zero outputs which prove nothing
+        :param start_epoch: number of epochs already done, e.g. by model restored with load(path, optim)
+        :param epoch_callback: called as epoch_callback(model, optim, epoch, stats) after every epoch,
+                               training stops if it returns False
+        """
         best_loss = float("inf")
-        for e in progressbar(range(num_epochs)):
+        self.train()
+        self.exact_metrics = exact_metrics
+        self.set_precision(precision)
+        self._reset_predictions_cache(len(data_loader.dataset))
+        self._running = StreamingBinaryMetrics()
+        for e in progressbar(range(start_epoch, num_epochs)):
             self._epoch = e
 
             iter_per_epoch = len(data_loader)
@@ -273,27 +497,34 @@ class BaseBinaryClassifier(BaseModel):
             for i in range(iter_per_epoch):
                 inputs, labels = self._get_inputs(data_iter)
 
-                predictions, classes = self.predict(inputs, return_classes=True)
+                predictions, classes = self.predict(inputs, return_classes=exact_metrics)
 
                 optim.zero_grad()
                 loss = loss_fn(predictions, labels)
                 loss.backward()
                 optim.step()
-
-                self._accumulate_results(self.to_np(labels).squeeze(),
-                                         classes,
-                                         loss=loss.data[0],
-                                         probs=self.to_np(predictions).squeeze())
-            stats = self.evaluate(logger, validation_data_loader, loss_fn, switch_to_eval=True)
-            is_best = stats["val_loss"] < best_loss
-            best_loss = min(best_loss, stats["val_loss"])
-            model_path = ProjectConfig.combine(ProjectConfig.model_directory,
-                                               "%s_%s_fold_%s.mdl" % (self.model_name, str(e + 1), self.fold_number))
-            self.save(model_path, optim, is_best, scores=stats)
+                self._log_step(logger, e, i, iter_per_epoch)
+
+                if exact_metrics:
+                    self._accumulate_results(self.to_np(labels).squeeze(),
+                                             classes,
+                                             loss=loss.data[0],
+                                             probs=self.to_np(predictions).squeeze())
+                else:
+                    self._running.update(predictions.data, labels.data, loss.data)
+            stats, best_loss = self._finish_epoch(optim, loss_fn, validation_data_loader, logger, best_loss)
+            if epoch_callback is not None and epoch_callback(self, optim, e, stats) is False:
+                break
+        self._flush_writers()
+        if precision != "float32":
+            self.check_precision(validation_data_loader, precision)
         return best_loss
 
 
 class BaseAutoEncoder(BaseModel):
+    # auto encoders reconstruct targets from targets, inputs may be noisy
+    _input_key = "targets"
+
     @abc.abstractmethod
     def forward(self, *args, **kwargs):
         pass
@@ -302,7 +533,7 @@ class BaseAutoEncoder(BaseModel):
         pass
 
     def predict(self, x, **kwargs):
-        predictions = self.__call__(x)
+        predictions = self._forward(x)
         return predictions
 
     @classmethod
@@ -377,8 +608,10 @@ class BaseAutoEncoder(BaseModel):
         for k, v in images.items():
             logger.image_summary(k, v, self._epoch + 1)
 
-    def fit(self, optim, loss_fn, data_loader, validation_data_loader, num_epochs, logger):
+    def fit(self, optim, loss_fn, data_loader, validation_data_loader, num_epochs, logger, precision="float32"):
         best_loss = float("inf")
+        self.set_precision(precision)
+        self._reset_predictions_cache(len(data_loader.dataset))
         start_point = random.randint(0, 32)
         for e in progressbar(range(num_epochs)):
             self._epoch = e
@@ -394,6 +627,7 @@ class BaseAutoEncoder(BaseModel):
                 loss = loss_fn(predictions, targets, mu, logvar)
                 loss.backward()
                 optim.step()
+                self._log_step(logger, e, i, iter_per_epoch)
 
                 self._accumulate_results(None, None, loss=loss.data[0])
             self._log_images(inputs, targets, predictions, logger, start=start_point,
@@ -403,5 +637,8 @@ class BaseAutoEncoder(BaseModel):
             best_loss = min(best_loss, stats["val_loss"])
             model_path = ProjectConfig.combine(ProjectConfig.model_directory,
                                                "%s_%s_fold_%s.mdl" % (self.model_name, str(e + 1), self.fold_number))
-            self.save(model_path, optim, is_best, scores=stats)
+            self._save_epoch(model_path, optim, is_best, stats)
+        self._flush_writers()
+        if precision != "float32":
+            self.check_precision(validation_data_loader, precision)
         return best_loss
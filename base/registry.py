@@ -0,0 +1,68 @@
+import os
+import threading
+import importlib
+import torch
+from base.exceptions import ProjectException
+
+
+ARTIFACT_FORMAT = "weights-v1"
+
+
+def load_artifact(path, mmap=True):
+    """
+    Read inference artifact written by BaseModel.export. Only tensors and plain python values are unpickled,
+    with mmap tensors are views of the file in page cache and are shared by all processes reading it
+    """
+    artifact = torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+    if not isinstance(artifact, dict) or artifact.get("format") != ARTIFACT_FORMAT:
+        raise ProjectException("%s is not inference artifact. Use BaseModel.export to make one!" % path)
+    return artifact
+
+
+def get_model_class(artifact):
+    module, _, name = artifact["model_class"].rpartition(".")
+    return getattr(importlib.import_module(module), name)
+
+
+class ModelRegistry:
+    """
+    Inference models of this process. Every artifact is loaded once per device and the same model
+    is returned to every caller, so scoring with many folds or ensembles holds one copy of each model.
+    Models are in eval mode without gradients and must not be trained or modified by callers
+    """
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _key(cls, path, device):
+        return os.path.realpath(path), str(device)
+
+    def get(self, path, device=None):
+        """
+        :param device: device of model, gpu if it is available by default
+        :rtype: base.model.BaseModel
+        """
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        key = self._key(path, device)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                artifact = load_artifact(path)
+                model = get_model_class(artifact).from_artifact(artifact)
+                if str(device) != "cpu":
+                    model.to(device)
+                self._models[key] = model
+        return model
+
+    def __contains__(self, path):
+        return any(key[0] == os.path.realpath(path) for key in self._models)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+# shared by all modules of this process
+REGISTRY = ModelRegistry()
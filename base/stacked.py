@@ -0,0 +1,224 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm as progressbar
+from base.exceptions import ProjectException
+from base.metrics import StreamingBinaryMetrics
+
+
+def stacked_conv2d(x, convs):
+    """
+    K convolutions of the same shape as one grouped convolution
+    :param x: tensor (B, K * C_in, H, W), channels of model k are [k * C_in, (k + 1) * C_in)
+    :return: tensor (B, K * C_out, H', W')
+    """
+    conv = convs[0]
+    weight = torch.cat([c.weight for c in convs])
+    bias = torch.cat([c.bias for c in convs]) if conv.bias is not None else None
+    return F.conv2d(x, weight, bias, conv.stride, conv.padding, conv.dilation, groups=len(convs) * conv.groups)
+
+
+def _masked_batch_norm(x, weight, bias, eps, sizes, channels):
+    # batch statistics of model k come from its first sizes[k] rows only, rows past them are padding
+    mask = torch.arange(x.size(0), device=x.device).unsqueeze(1) < torch.tensor(sizes, device=x.device)
+    mask = mask.repeat_interleave(channels, dim=1).to(x.dtype)[:, :, None, None]
+    count = mask.sum(dim=0, keepdim=True) * x.size(2) * x.size(3)
+    mean = (x * mask).sum(dim=(0, 2, 3), keepdim=True) / count
+    var = ((x - mean) ** 2 * mask).sum(dim=(0, 2, 3), keepdim=True) / count
+    out = (x - mean) * torch.rsqrt(var + eps) * weight[None, :, None, None] + bias[None, :, None, None]
+    # running variance is unbiased one, as of nn.BatchNorm2d
+    return out, mean.detach().flatten(), (var * count / (count - 1)).detach().flatten()
+
+
+def stacked_batch_norm(x, norms, sizes=None):
+    """
+    K BatchNorm2d layers over grouped channels. Running statistics stay in buffers of every layer
+    and are updated the same way as by nn.BatchNorm2d, momentum of every layer is respected
+    :param sizes: number of real rows of batch of every model, rows past them (padding, see ModelStack._get_inputs)
+                  are normalised but left out of batch statistics. All rows are real if None
+    """
+    norm = norms[0]
+    weight = torch.cat([n.weight for n in norms])
+    bias = torch.cat([n.bias for n in norms])
+    if not norm.training:
+        running_mean = torch.cat([n.running_mean for n in norms])
+        running_var = torch.cat([n.running_var for n in norms])
+        return F.batch_norm(x, running_mean, running_var, weight, bias, False, 0.0, norm.eps)
+    channels = norm.num_features
+    if sizes is not None and min(sizes) < x.size(0):
+        out, batch_mean, batch_var = _masked_batch_norm(x, weight, bias, norm.eps, sizes, channels)
+    else:
+        # with momentum 1 batch_norm stores batch mean and unbiased variance, models mix them with their own momentum
+        batch_mean = torch.zeros(x.size(1), dtype=x.dtype, device=x.device)
+        batch_var = torch.ones(x.size(1), dtype=x.dtype, device=x.device)
+        out = F.batch_norm(x, batch_mean, batch_var, weight, bias, True, 1.0, norm.eps)
+    with torch.no_grad():
+        for k, n in enumerate(norms):
+            n.running_mean.mul_(1 - n.momentum).add_(n.momentum * batch_mean[k * channels: (k + 1) * channels])
+            n.running_var.mul_(1 - n.momentum).add_(n.momentum * batch_var[k * channels: (k + 1) * channels])
+            n.num_batches_tracked += 1
+    return out
+
+
+def stacked_linear(x, linears):
+    """
+    :param x: tensor (K, B, in_features)
+    :return: tensor (K, B, out_features), one batched matrix multiplication for all models
+    """
+    weight = torch.stack([l.weight for l in linears]).transpose(1, 2)
+    if linears[0].bias is None:
+        return torch.bmm(x, weight)
+    bias = torch.stack([l.bias for l in linears]).unsqueeze(1)
+    return torch.baddbmm(bias, x, weight)
+
+
+def stacked_layer(x, layers, sizes=None):
+    """
+    Apply layer of every model (same position in the same architecture) to grouped tensor.
+    Layers without parameters (activations, pooling) are applied once to the whole tensor
+    :param sizes: number of real rows of every model, see stacked_batch_norm
+    """
+    layer = layers[0]
+    if isinstance(layer, nn.Conv2d):
+        return stacked_conv2d(x, layers)
+    if isinstance(layer, nn.BatchNorm2d):
+        return stacked_batch_norm(x, layers, sizes)
+    if isinstance(layer, nn.Linear):
+        return stacked_linear(x, layers)
+    if any(True for _ in layer.parameters()):
+        raise ProjectException("Layer %s cannot be stacked" % type(layer).__name__)
+    return layer(x)
+
+
+class ModelStack:
+    """
+    K independent models of the same class and shapes (folds or hyperparameter variants) trained
+    in one batched forward / backward pass. Model class provides stacked_forward(models, x).
+    Parameters are not copied: stacked weights are concatenated from parameters of the models on every step,
+    so every model keeps its own optimizer, gradients, buffers and is saved as usual BaseModel checkpoint
+    """
+    def __init__(self, models):
+        if not models:
+            raise ProjectException("Nothing to stack!")
+        model_class = type(models[0])
+        shapes = [(k, v.shape) for k, v in models[0].state_dict().items()]
+        for model in models[1:]:
+            if type(model) is not model_class or [(k, v.shape) for k, v in model.state_dict().items()] != shapes:
+                raise ProjectException("Only models of the same class and shapes can be stacked!")
+        self.models = models
+        self.model_class = model_class
+
+    def __len__(self):
+        return len(self.models)
+
+    def train(self, mode=True):
+        for model in self.models:
+            model.train(mode)
+        return self
+
+    def forward(self, x, shared=False, sizes=None):
+        """
+        :param x: tensor (K, B, ...) with own batch of every model
+        :param shared: x is one (B, ...) batch for all models
+        :param sizes: number of real rows of batch of every model, the others are padding, see _get_inputs
+        :return: tensor (K, B, ...) of outputs of every model
+        """
+        if shared:
+            x = x.unsqueeze(0).expand((len(self),) + tuple(x.size()))
+        return self.model_class.stacked_forward(self.models, x, sizes=sizes)
+
+    __call__ = forward
+
+    @classmethod
+    def _per_model(cls, value, num_models):
+        return list(value) if isinstance(value, (list, tuple)) else [value] * num_models
+
+    def _get_inputs(self, loaders, iterators):
+        """
+        Every model gets its own batch. Loader which is exhausted before the longest one is cycled,
+        so every model sees all of its samples every epoch. Smaller batches are padded to the largest one
+        by repeating their rows, padded rows are excluded from loss, metrics and batch norm statistics
+        :return: inputs (K, B, ...), targets (K, B, ...) and number of real rows of every batch
+        """
+        batches = []
+        for j, loader in enumerate(loaders):
+            try:
+                batches.append(next(iterators[j]))
+            except StopIteration:
+                iterators[j] = iter(loader)
+                batches.append(next(iterators[j]))
+        sizes = [b["inputs"].size(0) for b in batches]
+        size = max(sizes)
+        inputs, targets = [], []
+        for batch, rows in zip(batches, sizes):
+            index = None if rows == size else torch.arange(size) % rows
+            inputs.append(batch["inputs"] if index is None else batch["inputs"][index])
+            targets.append(batch["targets"] if index is None else batch["targets"][index])
+        model = self.models[0]
+        return model.to_var(torch.stack(inputs)), model.to_var(torch.stack(targets)), sizes
+
+    def fit(self, optimizers, loss_fn, data_loaders, validation_data_loaders, num_epochs, loggers, start_epoch=0,
+            epoch_callback=None):
+        """
+        Same as BaseBinaryClassifier.fit for every model. Per model arguments are lists of length K.
+        Epoch takes as many steps as the longest loader has batches, see _get_inputs
+        :param loss_fn: one loss function for all models or list of them
+        :param data_loaders: one loader per model, or one loader which feeds the same batches to all models
+        :param start_epoch: number of epochs already done by every model, e.g. restored with load(path, optim)
+        :param epoch_callback: one callback for all models or list of them, called as
+                               epoch_callback(model, optim, epoch, stats) after every epoch of every model.
+                               Model stops training if its callback returns False, the others go on
+        :return: list of best validation losses
+        """
+        num_models = len(self)
+        loss_fns = self._per_model(loss_fn, num_models)
+        callbacks = self._per_model(epoch_callback, num_models)
+        single_loader = not isinstance(data_loaders, (list, tuple))
+        loaders = self._per_model(data_loaders, num_models)
+        best_losses = [float("inf")] * num_models
+        for model, loader in zip(self.models, loaders):
+            model.exact_metrics = False
+            model.set_precision("float32")
+            model._reset_predictions_cache(len(loader.dataset))
+            model._running = StreamingBinaryMetrics()
+        self.train()
+        active = list(range(num_models))
+        for e in progressbar(range(start_epoch, num_epochs)):
+            # models stopped by their callbacks are left out of the stack
+            stack = self if len(active) == num_models else ModelStack([self.models[k] for k in active])
+            sources = loaders[:1] if single_loader else [loaders[k] for k in active]
+            iter_per_epoch = max(len(loader) for loader in sources)
+            iterators = [iter(loader) for loader in sources]
+            for i in range(iter_per_epoch):
+                inputs, labels, sizes = self._get_inputs(sources, iterators)
+                if single_loader:
+                    inputs = inputs.expand((len(active),) + tuple(inputs.size()[1:]))
+                    labels = labels.expand((len(active),) + tuple(labels.size()[1:]))
+                    sizes = sizes * len(active)
+                predictions = stack(inputs, sizes=sizes)
+
+                for k in active:
+                    optimizers[k].zero_grad()
+                predictions = [p[:rows] for p, rows in zip(predictions, sizes)]
+                labels = [l[:rows] for l, rows in zip(labels, sizes)]
+                losses = [loss_fns[k](p, l) for k, p, l in zip(active, predictions, labels)]
+                # parameters of models are disjoint, so gradient of sum is gradient of every loss for its model
+                sum(losses).backward()
+                for k in active:
+                    optimizers[k].step()
+                    self.models[k]._log_step(loggers[k], e, i, iter_per_epoch)
+
+                for k, p, l, loss in zip(active, predictions, labels, losses):
+                    self.models[k]._running.update(p.data, l.data, loss.data)
+            for k in list(active):
+                model = self.models[k]
+                model._epoch = e
+                stats, best_losses[k] = model._finish_epoch(optimizers[k], loss_fns[k], validation_data_loaders[k],
+                                                            loggers[k], best_losses[k])
+                if callbacks[k] is not None and callbacks[k](model, optimizers[k], e, stats) is False:
+                    active.remove(k)
+            if not active:
+                break
+        for model in self.models:
+            model._flush_writers()
+        return best_losses
@@ -1,24 +1,48 @@
 import numpy as np
 from tqdm import tqdm as progressbar
 from cnn.dataset import IcebergDataset
+from cnn.store import load_fold
+from cnn import feature_planes
 
 
 class AutoEncoderDataset(IcebergDataset):
+    def __init__(self, *args, noise_factor=0.4, batch_noise=False, **kwargs):
+        # noise_factor: probability of pixel to stay clean
+        # batch_noise: items carry only noise params, noise is added to the whole batch by BatchNoise
+        super().__init__(*args, **kwargs)
+        self.noise_factor = noise_factor
+        self.batch_noise = batch_noise
+        self.noise_params = self._get_noise_params()
+
+    def _get_noise_params(self, block_size=1024):
+        # mean and std of every plane of every image, array of shape (N, C, 2)
+        length = len(self)
+        params = []
+        for start in range(0, length, block_size):
+            stop = min(start + block_size, length)
+            if self.planes is not None:
+                planes = self.planes[self.rows[start: stop]]
+            else:
+                planes = feature_planes.compute_planes(self.get_images(start, stop), self.add_feature_planes)
+            planes = np.asarray(planes, dtype=np.float64)
+            params.append(np.stack((planes.mean(axis=(2, 3)), planes.std(axis=(2, 3))), axis=-1))
+        return np.concatenate(params).astype(np.float32)
+
+    def add_noise(self, image, params):
+        mask = np.random.binomial(1, 1 - self.noise_factor, image.shape)
+        noise = np.random.normal(loc=params[:, 0, None, None], scale=params[:, 1, None, None], size=image.shape)
+        return image + mask * noise
+
     def __getitem__(self, idx):
-        image = self._get_image(idx)
-        if self.add_feature_planes == "complex":
-            image = self._add_planes(image)
-        elif self.add_feature_planes == "simple":
-            image = self._get_simple_planes(image)
-        noise_factor = 0.4
-        planes = [image[i, :, :] for i in range(image.shape[0])]
-        stats = [self.get_image_stat(i) for i in planes]
-        masks = [np.random.binomial(1, 1 - noise_factor, i.shape) for i in planes]
-        noise = [masks[i] * np.random.normal(loc=stats[i][0], scale=stats[i][1],
-                                             size=masks[i].shape) for i in range(len(planes))]
-        noisy = [planes[i] + noise[i] for i in range(len(planes))]
-        noisy = np.stack(noisy, axis=0)
-        item = {"inputs": noisy, "targets": image}
+        if self.planes is not None:
+            image = np.array(self.planes[self._get_source_index(idx)])
+        else:
+            image = self.compute_planes(idx)
+        item = {"inputs": image, "targets": image}
+        if self.batch_noise:
+            item["noise"] = self.noise_params[idx]
+        else:
+            item["inputs"] = self.add_noise(image, self.noise_params[idx])
         if self.transform:
             item = self.transform(item)
         return item
@@ -32,8 +56,9 @@ class AutoEncoderDataset(IcebergDataset):
 
 
 if __name__ == "__main__":
-    ds1 = AutoEncoderDataset("../data/folds/test_0.npy", transform=None, im_dir="../data/vis/test",
-                             colormap="inferno", add_feature_planes="no")
+    _, test_indices = load_fold("../data/folds", 0)
+    ds1 = AutoEncoderDataset("../data/store/train", transform=None, im_dir="../data/vis/test",
+                             colormap="inferno", add_feature_planes="no", indices=test_indices)
     for i in progressbar(range(len(ds1))):
         sample = ds1[i]
         ds1.vis(i, average=True, prefix="")
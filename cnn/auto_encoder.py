@@ -1,7 +1,9 @@
 from torch.autograd import Variable
-from torchvision import transforms
 from torch import nn
 from base.model import BaseAutoEncoder
+from base.lazy import lazy_import
+
+transforms = lazy_import("torchvision.transforms")
 
 
 class IcebergEncoder(BaseAutoEncoder):
@@ -66,7 +68,7 @@ class IcebergEncoder(BaseAutoEncoder):
             self.fc2.weight.data.t_()
         enc = self.conv_encoder(x)  # shape N * 8 * 17 * 17
 
-        enc = enc.view(enc.size(0), -1)
+        enc = enc.reshape(enc.size(0), -1)
         enc = self.fc1(enc)
         enc = self.tanh(enc)
         enc = self.fc2(enc)
@@ -167,6 +169,7 @@ if __name__ == "__main__":
         import torch
         from tqdm import tqdm as progressbar
         import numpy as np
+        from base.metrics import PredictionAccumulator
 
         val_transform = transforms.Compose([
             Ravel(),
@@ -181,7 +184,7 @@ if __name__ == "__main__":
         iterator = iter(ldr)
         total_items = len(ds)
         iter_per_epoch = len(ldr)
-        all_predictions = np.array([])
+        results = PredictionAccumulator(total_items * 32)
         # all_labels = np.array([])
         for _ in progressbar(range(iter_per_epoch)):
             next_batch = next(iterator)
@@ -189,13 +192,14 @@ if __name__ == "__main__":
             inputs = encoder.to_var(inputs)
             result, _ = encoder.encode(inputs)
             res = encoder.to_np(result)
-            all_predictions = np.append(all_predictions, res)
+            results.append("codes", res)
             # labels = encoder.to_np(targets)
             # all_labels = np.append(all_labels, labels)
 
-        all_predictions = all_predictions.reshape(total_items, 32)
+        all_predictions = results["codes"].reshape(total_items, 32)
         # final = np.column_stack((all_predictions, all_labels))
         np.save("../data/encoder_test", all_predictions)
+        ds.close()
 
     infer()
     print("Done!")
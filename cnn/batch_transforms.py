@@ -0,0 +1,254 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from functools import lru_cache
+from torch.utils.data import get_worker_info
+from torch.utils.data.dataloader import default_collate
+from base.exceptions import ProjectException
+from base.lazy import lazy_import
+
+special = lazy_import("scipy.special")
+
+
+class BatchCollate:
+    """
+    collate_fn for DataLoader. Collates items as usual and then applies batch level transforms,
+    so augmentation runs once per batch instead of once per sample
+    """
+    def __init__(self, *transforms):
+        self.transforms = transforms
+
+    def __call__(self, items):
+        batch = default_collate(items)
+        for transform in self.transforms:
+            batch = transform(batch)
+        return batch
+
+
+class BatchTransform:
+    """
+    Base class of transforms applied to collated batch. Same random params are used for inputs and targets
+    """
+    def __init__(self, targets_also=False, shape=None, generator=None):
+        self.targets_also = targets_also
+        self.shape = shape  # restore (C, H, W) shape of raveled items
+        self.generator = generator
+
+    def draw(self, batch_size):
+        raise NotImplementedError()
+
+    @classmethod
+    def apply(cls, images, params):
+        raise NotImplementedError()
+
+    def _transform(self, tensor, params):
+        if self.shape is None:
+            return self.apply(tensor, params)
+        original_shape = tensor.size()
+        tensor = tensor.view((original_shape[0],) + tuple(self.shape))
+        return self.apply(tensor, params).view(original_shape)
+
+    def __call__(self, batch):
+        params = self.draw(batch["inputs"].size(0))
+        batch["inputs"] = self._transform(batch["inputs"], params)
+        if self.targets_also:
+            batch["targets"] = self._transform(batch["targets"], params)
+        return batch
+
+
+class BatchDihedral(BatchTransform):
+    """
+    Applies element of dihedral group D4 (4 rotations with and without flip) to every sample of (B, C, H, W) batch.
+    Element e means: flip along width if e >= 4, then rotate by 90 degrees (e % 4) times (np.rot90 direction).
+    By default elements are drawn the same way as for per sample
+    Flip(axis=2), Flip(axis=1), Rotate(90), Rotate(180) with rnd=True, i.e. each of them applied with probability 0.4
+    """
+    def __init__(self, probability=0.4, uniform=False, targets_also=False, shape=None, generator=None):
+        super().__init__(targets_also=targets_also, shape=shape, generator=generator)
+        self.probability = probability
+        self.uniform = uniform
+
+    @classmethod
+    def from_flags(cls, flags):
+        """
+        Reduce draws of per sample transforms to group elements
+        :param flags: bool or int tensor (B, 4) for Flip(axis=2), Flip(axis=1), Rotate(90), Rotate(180)
+        :return: long tensor (B,) of elements in [0, 8)
+        """
+        flags = flags.long()
+        flip_w, flip_h, rotate_90, rotate_180 = flags[:, 0], flags[:, 1], flags[:, 2], flags[:, 3]
+        # flip along height == flip along width followed by rotation by 180 degrees
+        flip = (flip_w + flip_h) % 2
+        rotations = (2 * flip_h + rotate_90 + 2 * rotate_180) % 4
+        return flip * 4 + rotations
+
+    def draw(self, batch_size):
+        if self.uniform:
+            return torch.randint(0, 8, (batch_size,), generator=self.generator, dtype=torch.long)
+        flags = torch.rand(batch_size, 4, generator=self.generator) < self.probability
+        return self.from_flags(flags)
+
+    @classmethod
+    def apply(cls, images, elements):
+        """
+        :param images: tensor (B, C, H, W)
+        :param elements: long tensor (B,) of group elements
+        :return: new tensor with transformed samples
+        """
+        result = images.clone()
+        for element in torch.unique(elements).tolist():
+            if element == 0:
+                continue
+            index = (elements == element).nonzero().view(-1).to(images.device)
+            selected = images.index_select(0, index)
+            if element >= 4:
+                selected = torch.flip(selected, dims=(3,))
+            if element % 4:
+                selected = torch.rot90(selected, element % 4, dims=(2, 3))
+            result.index_copy_(0, index, selected)
+        return result
+
+
+@lru_cache(maxsize=512)
+def rotation_indices(angle, height, width, mode="bilinear"):
+    """
+    Gather indices over flattened (height * width) image for rotation by angle (degrees) around the centre.
+    Geometry and border handling are the same as for ndimage.rotate(..., axes=(1, 0), mode="nearest", reshape=False)
+    :return: (indices, weights): long tensor (K, height * width) and float tensor (K, height * width),
+             K = 1 for "nearest" and 4 for "bilinear" mode
+    """
+    # cosine and sine in degrees and offset are computed exactly as by ndimage.rotate, so coordinates which
+    # are half pixel apart from two pixels (e.g. at -120 degrees) are rounded to the same pixel
+    cos, sin = float(special.cosdg(angle)), float(special.sindg(angle))
+    matrix = np.array([[cos, sin], [-sin, cos]])
+    centre = (np.array([height, width]) - 1) / 2
+    offset_r, offset_c = (centre - matrix @ centre).tolist()
+    rows = torch.arange(height, dtype=torch.float64).view(-1, 1).expand(height, width)
+    cols = torch.arange(width, dtype=torch.float64).view(1, -1).expand(height, width)
+    # coordinates in input image of every output pixel, clamped to border ("nearest" mode)
+    source_r = (offset_r + cos * rows + sin * cols).clamp(0, height - 1).reshape(-1)
+    source_c = (offset_c - sin * rows + cos * cols).clamp(0, width - 1).reshape(-1)
+    if mode == "nearest":
+        # ndimage rounds half pixel coordinates up, torch.round would round them to even
+        indices = (source_r + 0.5).floor().long() * width + (source_c + 0.5).floor().long()
+        return indices.view(1, -1), torch.ones(1, height * width)
+    elif mode == "bilinear":
+        r0, c0 = source_r.floor(), source_c.floor()
+        dr, dc = source_r - r0, source_c - c0
+        r0, c0 = r0.long(), c0.long()
+        r1, c1 = (r0 + 1).clamp(max=height - 1), (c0 + 1).clamp(max=width - 1)
+        indices = torch.stack((r0 * width + c0, r0 * width + c1, r1 * width + c0, r1 * width + c1))
+        weights = torch.stack(((1 - dr) * (1 - dc), (1 - dr) * dc, dr * (1 - dc), dr * dc)).float()
+        return indices, weights
+    raise ProjectException("Unknown interpolation mode. Use one of (nearest, bilinear)")
+
+
+class BatchRotate(BatchTransform):
+    """
+    Rotation by arbitrary angle for the whole (B, C, H, W) batch.
+    Angles are drawn uniformly from [-max_angle, max_angle] and rounded to buckets of `step` degrees,
+    gather indices of every bucket are computed once and cached, so rotation of all samples and channels
+    which fall into one bucket is a single index_select
+    """
+    def __init__(self, max_angle=180.0, step=1.0, probability=0.4, mode="bilinear",
+                 targets_also=False, shape=None, generator=None):
+        super().__init__(targets_also=targets_also, shape=shape, generator=generator)
+        self.max_angle = max_angle
+        self.step = step
+        self.probability = probability
+        self.mode = mode
+
+    def draw(self, batch_size):
+        angles = (torch.rand(batch_size, generator=self.generator) * 2 - 1) * self.max_angle
+        buckets = torch.round(angles / self.step).long()
+        rotate = torch.rand(batch_size, generator=self.generator) < self.probability
+        buckets[~rotate] = 0
+        return buckets * self.step, self.mode
+
+    @classmethod
+    def rotate(cls, images, angle, mode="bilinear"):
+        batch_size, channels, height, width = images.size()
+        indices, weights = rotation_indices(float(angle), height, width, mode)
+        indices, weights = indices.to(images.device), weights.to(images.device, images.dtype)
+        flat = images.contiguous().view(batch_size, channels, height * width)
+        gathered = flat.index_select(2, indices.view(-1)).view(batch_size, channels, indices.size(0), -1)
+        result = (gathered * weights).sum(2)
+        return result.view(batch_size, channels, height, width)
+
+    @classmethod
+    def apply(cls, images, params):
+        angles, mode = params
+        result = images.clone()
+        for angle in torch.unique(angles).tolist():
+            if angle == 0:
+                continue
+            index = (angles == angle).nonzero().view(-1).to(images.device)
+            selected = cls.rotate(images.index_select(0, index), angle, mode)
+            result.index_copy_(0, index, selected)
+        return result
+
+
+class BatchResize(BatchTransform):
+    """
+    Resize of the whole (B, C, H, W) batch with one interpolate call.
+    Default "nearest-exact" mode picks the same pixels as skimage resize(..., order=0) used by per sample Scale
+    """
+    def __init__(self, size, mode="nearest-exact", targets_also=False, shape=None):
+        super().__init__(targets_also=targets_also, shape=shape)
+        self.size = tuple(size)
+        self.mode = mode
+
+    def draw(self, batch_size):
+        return self.size, self.mode
+
+    @classmethod
+    def apply(cls, images, params):
+        size, mode = params
+        return F.interpolate(images, size=size, mode=mode)
+
+    def _transform(self, tensor, params):
+        # size of the result differs from the input, so raveled items are raveled back with the new size
+        if self.shape is None:
+            return self.apply(tensor, params)
+        tensor = tensor.view((tensor.size(0),) + tuple(self.shape))
+        return self.apply(tensor, params).view(tensor.size(0), -1)
+
+
+class BatchNoise:
+    """
+    Masked gaussian noise of denoising auto encoders added to the whole batch: inputs = targets + mask * noise.
+    Mask keeps pixel clean with probability noise_factor, noise of every plane is drawn from N(mean, std)
+    given by per item "noise" params of shape (C, 2), see AutoEncoderDataset(batch_noise=True).
+    Generator is created in the process which runs collation. Without seed it is seeded from torch.initial_seed(),
+    which is different for every DataLoader worker and epoch. Explicit seed (plus worker id)
+    repeats the same noise every epoch, e.g. for validation
+    """
+    def __init__(self, noise_factor=0.4, shape=None, seed=None):
+        self.noise_factor = noise_factor
+        self.shape = shape
+        self.seed = seed
+        self.generator = None
+
+    def _get_generator(self):
+        if self.generator is None:
+            if self.seed is None:
+                seed = torch.initial_seed()
+            else:
+                worker = get_worker_info()
+                seed = self.seed + (worker.id if worker is not None else 0)
+            self.generator = torch.Generator()
+            self.generator.manual_seed(seed)
+        return self.generator
+
+    def __call__(self, batch):
+        params = batch.pop("noise")
+        targets = batch["targets"]
+        if self.shape is not None:
+            targets = targets.view((targets.size(0),) + tuple(self.shape))
+        generator = self._get_generator()
+        mean, std = params[:, :, 0, None, None], params[:, :, 1, None, None]
+        mask = torch.rand(targets.size(), generator=generator) < 1 - self.noise_factor
+        noise = torch.randn(targets.size(), generator=generator) * std + mean
+        inputs = targets + mask.to(targets.dtype) * noise
+        batch["inputs"] = inputs.view(batch["targets"].size())
+        return batch
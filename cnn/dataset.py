@@ -1,20 +1,26 @@
 import numpy as np
-import pandas as pd
 import os
+import hashlib
 import random
-import matplotlib.pyplot as plt
 from tqdm import tqdm as progressbar
-from torchvision import transforms
-from scipy import ndimage, signal
 from base.dataset import BaseDataset, ToTensor
 from base.exceptions import ProjectException
-from skimage.transform import resize
+from cnn.store import IcebergStore, share_json, from_legacy
+from cnn.feature_planes import PlaneCache
+from cnn.stats import load_stats
+from base.lazy import lazy_import
 
+plt = lazy_import("matplotlib.pyplot")
+ndimage = lazy_import("scipy.ndimage")
+signal = lazy_import("scipy.signal")
+skimage_transform = lazy_import("skimage.transform")
 
-# scaler params computed on dataset
+
+# scaler params computed on dataset, use cnn.stats to profile new data
 MIN_MAX = {"min1": -45.594448, "min2": -45.655499, "max1": 34.574917, "max2": 20.154249}
 MU_SIGMA = {"mu1": -20.655831, "mu2": -26.320702, "sigma1": 5.200838, "sigma2": 3.395518}
 MED_Q = {'med1': -21.0596, 'med2': -26.3451, 'q1_1': -24.1442, 'q1_2': -28.3731, 'q3_1': -17.5402, 'q3_2': -24.3858}
+MEAN_ANGLE = 39.26
 
 
 class Scale:
@@ -24,7 +30,7 @@ class Scale:
     def __call__(self, item):
         image = item["inputs"]
         image = np.transpose(image, (1, 2, 0))
-        image = resize(image, (self.h, self.w), order=0, mode='constant')
+        image = skimage_transform.resize(image, (self.h, self.w), order=0, mode='constant')
         image = np.transpose(image, (2, 0, 1))
         # image = ndimage.zoom(image, (c, self.h, self.w), order=0)   # bilinear, 0 for nearest, 3 for cubic
         item["inputs"] = image
@@ -37,7 +43,7 @@ class Ravel:
         targets = item["targets"]
         image = image.ravel()
         targets = targets.ravel()
-        item = {"inputs": image, "targets": targets}
+        item = dict(item, inputs=image, targets=targets)
         return item
 
 
@@ -116,37 +122,84 @@ class Flip:
 
 class IcebergDataset(BaseDataset):
     def __init__(self, path, inference_only=False, transform=None, im_dir=None, colormap="inferno",
-                 top=None, mu_sigma=MU_SIGMA, denoise=False, add_feature_planes="no", width=75, return_angle=False):
+                 top=None, mu_sigma=MU_SIGMA, denoise=False, add_feature_planes="no", width=75, return_angle=False,
+                 eager=False, cache_planes=False, indices=None, stats=None):
         # add_feature_planes: one of "no", "simple", "complex"
+        # indices: rows of IcebergStore which belong to this dataset (e.g. one fold), whole store by default
+        # stats: scaler params produced by cnn.stats (dict or path to stats file), constants of this module by default
+        # eager: normalise whole dataset once at load time and keep it as float32 array
+        # cache_planes: read feature planes from persistent on-disk cache, build it if missing
         self.add_feature_planes = add_feature_planes
         self.return_angle = return_angle
         self.transform = transform
         self.denoise = denoise
         self.colormap = colormap
-        self.mu_sigma = mu_sigma
+        self.stats = load_stats(stats) if isinstance(stats, str) else stats
+        self.med_q = self.stats["med_q"] if self.stats else MED_Q
+        self.mu_sigma = self.stats["mu_sigma"] if self.stats and mu_sigma is not None else mu_sigma
         self.inference_only = inference_only
         self.im_dir = im_dir
         self.width = width  # according to dataset each "picture" is unrolled 75 * 75 "image"
-        if inference_only:
-            data = pd.read_json(path)
-            self.data = data[["band_1", "band_2", "inc_angle"]].as_matrix()
-            self.ids = data["id"].tolist()
+        # json and legacy data are copied to shared memory store owned by this dataset, see close()
+        self._owns_store = not (isinstance(path, IcebergStore) or IcebergStore.is_store(path))
+        if not self._owns_store:
+            self._init_from_store(path, top, indices)
+        elif inference_only:
+            # json is streamed into shared memory store, neither parsed file nor all bands are held in memory
+            self._init_from_store(share_json(path), top, indices)
         else:
-            self.data = np.load(path)
-            if top:
-                self.data = self.data[:top, :]
-            self.y = self.data[:, -1]
-        self.ch1 = self.data[:, 0]
-        self.ch2 = self.data[:, 1]
-        self.angle = self.data[:, 2]
-        print_string = "Ds length %s \t" % self.data.shape[0]
+            # object arrays of python lists are copied on write by every forked worker,
+            # so legacy .npy files are converted to float32 buffers in shared memory
+            self._init_from_store(from_legacy(np.load(path, allow_pickle=True)).share(), top, indices)
+        print_string = "Ds length %s \t" % len(self)
         if not inference_only:
             print_string += "Positive %s\n" % sum(self.y)
         print(print_string)
         self.num_feature_planes = 2     # by default
+        self.images = None
+        if eager:
+            self.images = self._normalize_all()
+        self.planes = None
+        if cache_planes and add_feature_planes != "no":
+            self.planes = PlaneCache().load(self._get_cache_source())
+            self.num_feature_planes = self.planes.shape[1]
+
+    def _init_from_store(self, path, top, indices):
+        store = path if isinstance(path, IcebergStore) else IcebergStore.open(path)
+        if not self.inference_only and not store.has_labels:
+            raise ProjectException("Dataset %s has no labels. Use inference mode!" % store.directory)
+        self.store = store
+        rows = np.arange(len(store)) if indices is None else np.asarray(indices, dtype=np.int64)
+        if top:
+            rows = rows[:top]
+        # bands stay memory mapped and shared by all folds, only small per row arrays are copied
+        self.rows = rows
+        self.bands = store.bands
+        self.angle = store.angle[rows]
+        self.ids = store.ids[rows]
+        if store.has_labels:
+            self.y = store.labels[rows]
+
+    def close(self):
+        """
+        Remove shared memory copy of json / legacy data made by this dataset.
+        Datasets over existing stores do nothing, their store belongs to the caller
+        """
+        if self._owns_store:
+            self.store.close()
+
+    def _get_cache_source(self):
+        # planes of store backed datasets are cached for the whole store, so folds share one cache file
+        if np.array_equal(self.rows, np.arange(len(self.store))):
+            return self
+        return IcebergDataset(self.store, inference_only=True, mu_sigma=self.mu_sigma, denoise=self.denoise,
+                              add_feature_planes=self.add_feature_planes, width=self.width, stats=self.stats)
+
+    def _get_source_index(self, idx):
+        return self.rows[idx]
 
     def __len__(self):
-        return self.data.shape[0]
+        return self.angle.shape[0]
 
     @classmethod
     def get_image_stat(cls, image):
@@ -158,14 +211,16 @@ class IcebergDataset(BaseDataset):
         percentile_75 = np.percentile(image, 75)
         return mean_1, std_1, median_1, maximum, minimum, percentile_75
 
+    def _get_bands(self, idx):
+        # float32 memory mapped store; cast keeps per-item arithmetic identical to json based data
+        row = self.rows[idx]
+        return self.bands[row, 0].astype(np.float64), self.bands[row, 1].astype(np.float64)
+
     def _get_image(self, idx):
-        ch_1 = self.ch1[idx]
-        ch_2 = self.ch2[idx]
-        ch1_2d = np.reshape(ch_1, (self.width, self.width))
-        ch2_2d = np.reshape(ch_2, (self.width, self.width))
+        ch1_2d, ch2_2d = self._get_bands(idx)
         angle = self.angle[idx]
-        if not isinstance(angle, float):
-            angle = 39.26   # mean angle = 39.26
+        if not isinstance(angle, (float, np.floating)) or np.isnan(angle):
+            angle = MEAN_ANGLE
         multiplier = np.cos(np.deg2rad(angle))
         if self.denoise:
             ch1_2d = self._denoise(ch1_2d)
@@ -173,11 +228,52 @@ class IcebergDataset(BaseDataset):
         if self.mu_sigma is not None:
             # ch1_2d = (ch1_2d - self.mu_sigma["mu1"]) / (self.mu_sigma["sigma1"]) * multiplier
             # ch2_2d = (ch2_2d - self.mu_sigma["mu2"]) / (self.mu_sigma["sigma2"]) * multiplier
-            ch1_2d = (ch1_2d - MED_Q["med1"]) / (MED_Q["q3_1"] - MED_Q["q1_1"]) * multiplier / 3
-            ch2_2d = (ch2_2d - MED_Q["med2"]) / (MED_Q["q3_2"] - MED_Q["q1_2"]) * multiplier / 3
+            med_q = self.med_q
+            ch1_2d = (ch1_2d - med_q["med1"]) / (med_q["q3_1"] - med_q["q1_1"]) * multiplier / 3
+            ch2_2d = (ch2_2d - med_q["med2"]) / (med_q["q3_2"] - med_q["q1_2"]) * multiplier / 3
         image = np.stack((ch1_2d, ch2_2d), axis=0)  # PyTorch uses NCHW ordering
         return image
 
+    def _get_all_bands(self, start, stop):
+        return self.bands[self.rows[start: stop]]
+
+    def _get_all_angles(self, start, stop):
+        return np.array(self.angle[start: stop], dtype=np.float32)
+
+    def _normalize_block(self, bands, angles):
+        # vectorised version of _get_image over (N, 2, width, width) block
+        angles = np.where(np.isnan(angles), MEAN_ANGLE, angles)
+        multiplier = np.cos(np.deg2rad(angles)).astype(np.float32)[:, None, None, None]
+        images = np.array(bands, dtype=np.float32)
+        if self.denoise:
+            images = ndimage.gaussian_filter(images, sigma=(0, 0, 2, 2))
+        if self.mu_sigma is not None:
+            med_q = self.med_q
+            median = np.array([med_q["med1"], med_q["med2"]], dtype=np.float32)[None, :, None, None]
+            iqr = np.array([med_q["q3_1"] - med_q["q1_1"],
+                            med_q["q3_2"] - med_q["q1_2"]], dtype=np.float32)[None, :, None, None]
+            # (x - median) / iqr * multiplier / 3 folded into one in place multiply-add per (N, C) plane
+            scale = multiplier / (3 * iqr)
+            images *= scale
+            images -= median * scale
+        return images
+
+    def get_images(self, start, stop):
+        # normalised (stop - start, 2, width, width) block of images
+        if self.images is not None:
+            return self.images[start: stop]
+        return self._normalize_block(self._get_all_bands(start, stop), self._get_all_angles(start, stop))
+
+    def _normalize_all(self, block_size=1024):
+        length = len(self)
+        images = np.empty((length, 2, self.width, self.width), dtype=np.float32)
+        for start in range(0, length, block_size):
+            stop = min(start + block_size, length)
+            bands = self._get_all_bands(start, stop)
+            angles = self._get_all_angles(start, stop)
+            images[start: stop] = self._normalize_block(bands, angles)
+        return images
+
     def get_labels(self):
         if not self.inference_only:
             labels = self.y
@@ -243,12 +339,38 @@ class IcebergDataset(BaseDataset):
         self.num_feature_planes = image.shape[0]
         return image
 
-    def __getitem__(self, idx):
-        image = self._get_image(idx)
+    def cache_params(self):
+        # everything feature planes depend on, except the data itself
+        params = {"planes": self.add_feature_planes, "width": self.width, "denoise": self.denoise,
+                  "scaled": self.mu_sigma is not None, "med_q": self.med_q, "mean_angle": MEAN_ANGLE}
+        return params
+
+    def data_hash(self, block_size=1024):
+        digest = hashlib.sha1()
+        length = len(self)
+        for start in range(0, length, block_size):
+            stop = min(start + block_size, length)
+            bands = np.ascontiguousarray(self._get_all_bands(start, stop), dtype=np.float32)
+            digest.update(bands.tobytes())
+            digest.update(self._get_all_angles(start, stop).tobytes())
+        return digest.hexdigest()
+
+    def compute_planes(self, idx):
+        if self.images is not None:
+            image = self.images[idx]
+        else:
+            image = self._get_image(idx)
         if self.add_feature_planes == "complex":
             image = self._add_planes(image)
         elif self.add_feature_planes == "simple":
             image = self._get_simple_planes(image)
+        return image
+
+    def __getitem__(self, idx):
+        if self.planes is not None:
+            image = np.array(self.planes[self._get_source_index(idx)])
+        else:
+            image = self.compute_planes(idx)
         item = {"inputs": image}
         if self.return_angle:
             item["angle"] = np.array([self.angle[idx]])
@@ -327,6 +449,7 @@ def _test_set():
 
 if __name__ == "__main__":
     from torch.utils.data import DataLoader
+    from torchvision import transforms
 
 
     def train_set():
@@ -337,7 +460,7 @@ if __name__ == "__main__":
         t5 = transforms.Compose([Flip(axis=1), Flip(axis=2), ToTensor()])
         t6 = transforms.Compose([Rotate(90), ToTensor()])
 
-        ds1 = IcebergDataset("../data/all.npy", transform=None, im_dir="../data/vis/train",
+        ds1 = IcebergDataset("../data/store/train", transform=None, im_dir="../data/vis/train",
                              colormap="inferno", add_feature_planes="complex")
         for i in progressbar(range(len(ds1))):
             sample = ds1[i]
@@ -0,0 +1,199 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm as progressbar
+from base.config import ProjectConfig
+from base.exceptions import ProjectException
+from cnn.batch_transforms import BatchResize
+from base.lazy import lazy_import
+
+ndimage = lazy_import("scipy.ndimage")
+fft = lazy_import("scipy.fft")
+
+
+def _normalize_planes(planes):
+    # per image (x - mean) / (max - min) in place, planes is contiguous (N, C, H, W) array
+    flat = planes.reshape(planes.shape[0] * planes.shape[1], -1)
+    mean = flat.mean(axis=1, keepdims=True)
+    spread = flat.max(axis=1, keepdims=True) - flat.min(axis=1, keepdims=True)
+    flat -= mean
+    flat /= spread
+    return planes
+
+
+def _median_of_three(a, b, c):
+    return np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+
+
+def median_filter_3x3(images):
+    """
+    Same result as ndimage.median_filter(image, 3) applied to every (H, W) plane of images.
+    Each column triple is sorted once and shared by neighbouring windows:
+    median = med3(max of column minimums, med3 of column medians, min of column maximums)
+    """
+    padding = [(0, 0)] * (images.ndim - 2) + [(1, 1), (1, 1)]
+    padded = np.pad(images, padding, mode="symmetric")  # same as "reflect" mode of ndimage
+    top, middle, bottom = padded[..., :-2, :], padded[..., 1:-1, :], padded[..., 2:, :]
+    low = np.minimum(top, middle)
+    high = np.maximum(top, middle)
+    medium = np.maximum(low, np.minimum(high, bottom))
+    low = np.minimum(low, bottom)
+    high = np.maximum(high, bottom)
+    max_low = np.maximum(np.maximum(low[..., :-2], low[..., 1:-1]), low[..., 2:])
+    min_high = np.minimum(np.minimum(high[..., :-2], high[..., 1:-1]), high[..., 2:])
+    med_medium = _median_of_three(medium[..., :-2], medium[..., 1:-1], medium[..., 2:])
+    return _median_of_three(max_low, med_medium, min_high)
+
+
+def autocorrelate(images):
+    """
+    Batched equivalent of signal.correlate(im, im, mode="same") using rfft2, for any image size
+    :param images: array of shape (N, H, W)
+    :return: array of shape (N, H, W)
+    """
+    _, height, width = images.shape
+    # "same" mode needs lags up to half of the image, smaller padding than full correlation is enough
+    fft_shape = (fft.next_fast_len(height + height // 2, real=True),
+                 fft.next_fast_len(width + width // 2, real=True))
+    # scipy.fft keeps float32 input in single precision, numpy.fft would compute in float64
+    spectrum = fft.rfft2(images, s=fft_shape)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    circular = fft.irfft2(power, s=fft_shape)
+    # circular[:, u, v] holds correlation for lag (u, v) modulo fft_shape,
+    # "same" mode puts zero lag at (H // 2, W // 2) as scipy does
+    rows = (np.arange(height) - height // 2) % fft_shape[0]
+    cols = (np.arange(width) - width // 2) % fft_shape[1]
+    return circular[:, rows[:, None], cols[None, :]]
+
+
+def simple_planes(images, step=16):
+    """
+    Batched version of IcebergDataset._get_simple_planes
+    :param images: array of shape (N, 2, H, W)
+    :param step: images per inner block, small enough for every pass over a block to stay in cache
+    :return: float32 array of shape (N, 3, H, W)
+    """
+    images = np.asarray(images, dtype=np.float32)
+    planes = np.empty((images.shape[0], 3) + images.shape[2:], dtype=np.float32)
+    for start in range(0, images.shape[0], step):
+        block = images[start: start + step]
+        out = planes[start: start + step]
+        out[:, :2] = block
+        np.add(block[:, 0], block[:, 1], out=out[:, 2])
+        out[:, 2] *= 0.5
+        _normalize_planes(out)
+    return planes
+
+
+def complex_planes(images):
+    """
+    Batched version of IcebergDataset._add_planes. Filters are restricted to spatial axes
+    :param images: array of shape (N, 2, H, W)
+    :return: float32 array of shape (N, 7, H, W)
+    """
+    images = np.asarray(images, dtype=np.float32)
+    averaged = images.mean(axis=1)
+    multiplied = images[:, 0] * images[:, 1]
+    to_filter = np.stack((averaged, multiplied), axis=1)
+    gauss = ndimage.gaussian_filter(to_filter, sigma=(0, 0, 2, 2))
+    median = median_filter_3x3(to_filter)
+
+    gray = images.sum(axis=1)
+    gray -= gray.mean(axis=(1, 2), keepdims=True)
+    correlated = autocorrelate(gray)
+    correlated /= np.abs(correlated.max(axis=(1, 2), keepdims=True))
+    planes = np.stack((images[:, 0], images[:, 1], median[:, 0], gauss[:, 0], correlated,
+                       median[:, 1], gauss[:, 1]), axis=1)
+    return planes
+
+
+def compute_planes(images, mode):
+    """
+    Compute feature planes for a whole (N, 2, H, W) block of normalised images at once
+    :param images: array of shape (N, 2, H, W)
+    :param mode: one of "no", "simple", "complex"
+    :return: float32 array of shape (N, C, H, W)
+    """
+    if mode == "complex":
+        return complex_planes(images)
+    elif mode == "simple":
+        return simple_planes(images)
+    elif mode == "no":
+        return np.asarray(images, dtype=np.float32)
+    raise ProjectException("Unknown feature planes mode. Use one of (no, simple, complex)")
+
+
+class PlaneCache:
+    """
+    On-disk cache of precomputed feature planes. Planes do not depend on augmentation,
+    so they are computed once per (source data, plane mode, normalisation constants)
+    and stored as (N, C, width, width) float32 .npy file which is opened memory mapped.
+    """
+    def __init__(self, directory=ProjectConfig.cache_directory, workers=None):
+        self.directory = directory
+        # numpy, fft and ndimage release GIL, so blocks are computed in parallel threads
+        self.workers = workers or os.cpu_count() or 1
+
+    @classmethod
+    def get_key(cls, dataset):
+        params = dataset.cache_params()
+        params["data"] = dataset.data_hash()
+        serialized = json.dumps(params, sort_keys=True).encode("utf-8")
+        key = hashlib.sha1(serialized).hexdigest()
+        return key
+
+    def get_path(self, dataset):
+        name = "planes_%s_%s.npy" % (dataset.add_feature_planes, self.get_key(dataset))
+        return os.path.join(self.directory, name)
+
+    def load(self, dataset):
+        path = self.get_path(dataset)
+        if not os.path.isfile(path):
+            self._build(dataset, path)
+        planes = np.load(path, mmap_mode="r")
+        return planes
+
+    def load_resized(self, dataset, size, mode="nearest-exact"):
+        """
+        Feature planes of dataset resized to size, e.g. (224, 224) for pretrained imagenet models.
+        Meant for validation sets which are resized the same way every epoch
+        """
+        params = "%s_%s_%s" % (self.get_key(dataset), tuple(size), mode)
+        key = hashlib.sha1(params.encode("utf-8")).hexdigest()
+        name = "resized_%s_%s.npy" % (dataset.add_feature_planes, key)
+        path = os.path.join(self.directory, name)
+        if not os.path.isfile(path):
+            self._build(dataset, path, size=size, resize_mode=mode)
+        planes = np.load(path, mmap_mode="r")
+        return planes
+
+    def _build(self, dataset, path, block_size=256, size=None, resize_mode="nearest-exact"):
+        os.makedirs(self.directory, exist_ok=True)
+        length = len(dataset)
+        mode = dataset.add_feature_planes
+        channels = compute_planes(dataset.get_images(0, 1), mode).shape[1]
+        height, width = size or (dataset.width, dataset.width)
+        shape = (length, channels, height, width)
+
+        def compute_block(begin):
+            planes = compute_planes(dataset.get_images(begin, min(begin + block_size, length)), mode)
+            if size is None:
+                return planes
+            return BatchResize.apply(torch.from_numpy(planes), ((height, width), resize_mode)).numpy()
+
+        # write to temporary file first, so concurrent readers never see partially built cache
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        planes = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=shape)
+        starts = list(range(0, length, block_size))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for i in progressbar(range(0, len(starts), self.workers)):
+                group = starts[i: i + self.workers]
+                for start, block in zip(group, pool.map(compute_block, group)):
+                    planes[start: start + block.shape[0]] = block
+        planes.flush()
+        del planes
+        os.replace(tmp_path, path)
+        print("Feature planes are cached to %s" % path)
@@ -5,33 +5,39 @@ import torch.optim as optim
 from torch.optim import lr_scheduler
 from torch.autograd import Variable
 import numpy as np
-import torchvision
-from torchvision import datasets, models, transforms
-import matplotlib.pyplot as plt
 from torch.utils.data import DataLoader
 import time
 import os
-from cnn.dataset import IcebergDataset, Flip, Rotate, ToTensor, Scale
-from tensorboardX import SummaryWriter
+from cnn.dataset import IcebergDataset, ToTensor
+from cnn.store import IcebergStore, load_fold
+from cnn.feature_planes import PlaneCache
+from cnn.batch_transforms import BatchCollate, BatchDihedral, BatchResize
+from base.dataset import ArrayDataset
+from base.lazy import lazy_import
 
-WRITER = SummaryWriter()
+models = lazy_import("torchvision.models")
+tensorboardX = lazy_import("tensorboardX")
 
+# SummaryWriter creates its log folder, so it is made on the first write, not at import
+WRITER = None
 
-ONE_TRANSFORM = transforms.Compose(
-        [
-            Scale((224, 224)),
-            Flip(axis=2, rnd=True),
-            Flip(axis=1, rnd=True),
-            Rotate(90, rnd=True),
-            Rotate(180, rnd=True),
-            ToTensor()
-        ]
-    )
-SECOND_TRANSFORM = transforms.Compose([Scale((224, 224)), ToTensor()])
+
+def _get_writer():
+    global WRITER
+    if WRITER is None:
+        WRITER = tensorboardX.SummaryWriter()
+    return WRITER
+
+
+SIZE = (224, 224)
+ONE_TRANSFORM = ToTensor()
+# flips and rotations are applied to small 75x75 images, upscaling is done once for the whole batch
+TRAIN_COLLATE = BatchCollate(BatchDihedral(), BatchResize(SIZE))
 
 
 def train_one_config(num_folds):
     scores = []
+    store = IcebergStore.open("../data/store/train")
 
     for f in range(num_folds):
         model_ft = models.resnet18(pretrained=True)
@@ -44,13 +50,15 @@ def train_one_config(num_folds):
 
         criterion = nn.BCEWithLogitsLoss()
 
-        train_set = IcebergDataset("../data/folds/train_%s.npy" % f, transform=ONE_TRANSFORM,
-                                   add_feature_planes="simple")
+        train_indices, val_indices = load_fold("../data/folds", f)
+        train_set = IcebergDataset(store, transform=ONE_TRANSFORM, add_feature_planes="simple",
+                                   indices=train_indices)
 
-        val_ds = IcebergDataset("../data/folds/test_%s.npy" % f, transform=SECOND_TRANSFORM,
-                                add_feature_planes="simple")
+        val_source = IcebergDataset(store, add_feature_planes="simple", indices=val_indices)
+        # validation set is upscaled once and kept on disk
+        val_ds = ArrayDataset(PlaneCache().load_resized(val_source, SIZE), val_source.y, transform=ToTensor())
 
-        train_loader = DataLoader(train_set, batch_size=128, num_workers=6,
+        train_loader = DataLoader(train_set, batch_size=128, num_workers=6, collate_fn=TRAIN_COLLATE,
                                   pin_memory=True, shuffle=True)
         val_loader = DataLoader(val_ds, batch_size=64, num_workers=6, pin_memory=True)
         dataloaders = {"train": train_loader, "val": val_loader}
@@ -117,9 +125,10 @@ def train_model(dataloaders, dataset_sizes, model, criterion, optimizer, schedul
 
             epoch_loss = running_loss / dataset_sizes[phase]
             epoch_acc = running_corrects / dataset_sizes[phase]
-            WRITER.add_scalar('loss', epoch_loss, epoch)
-            WRITER.add_scalar('acc', epoch_acc, epoch)
-            WRITER.add_text('Text', 'text logged at step:' + str(epoch), epoch)
+            writer = _get_writer()
+            writer.add_scalar('loss', epoch_loss, epoch)
+            writer.add_scalar('acc', epoch_acc, epoch)
+            writer.add_text('Text', 'text logged at step:' + str(epoch), epoch)
 
             print('{} Loss: {:.4f} Acc: {:.4f}'.format(
                 phase, epoch_loss, epoch_acc))
@@ -120,7 +120,7 @@ class Inception(BaseBinaryClassifier):
         out = self.inception_e_2(out)
         out = self.pool(out)
 
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         out = self.fc1(out)
         out = self.ac_func(out)
         out = self.fc2(out)
@@ -1,12 +1,21 @@
 from cnn.dataset import IcebergDataset, ToTensor
+from cnn.store import IcebergStore, iter_chunks
 from cnn.model import LeNet
 from cnn.inception import Inception
 from torch.utils.data import DataLoader
 from tqdm import tqdm as progressbar
 from collections import defaultdict
-import pandas as pd
+import os
 import numpy as np
 import torch
+from base.lazy import lazy_import
+from base.registry import REGISTRY
+
+pd = lazy_import("pandas")
+
+
+FINAL_CHECKPOINT = "../models/LeNet_78_fold_None.mdl"
+FINAL_ARTIFACT = "../models/LeNet_78_fold_None.pt"
 
 
 def softmax(x):
@@ -14,27 +23,43 @@ def softmax(x):
     return e_x / e_x.sum()
 
 
-def infer(path, num_folds, average=True):
-    ds = IcebergDataset(path, inference_only=True, transform=ToTensor(), add_feature_planes="no")
-    loader = DataLoader(ds, 64)
+def _iter_datasets(path, chunk_size):
+    if IcebergStore.is_store(path):
+        yield IcebergDataset(path, inference_only=True, transform=ToTensor(), add_feature_planes="no")
+    else:
+        # json is streamed chunk by chunk so memory stays flat for any size of input file
+        for chunk in iter_chunks(path, chunk_size=chunk_size):
+            yield IcebergDataset(chunk, inference_only=True, transform=ToTensor(), add_feature_planes="no")
+
+
+def infer(path, num_folds, average=True, chunk_size=1024, artifacts=None):
+    """
+    :param artifacts: inference artifacts of folds (see BaseModel.export), the final model for every fold by default.
+                      Every artifact is loaded once per process by REGISTRY
+    """
     predictions = defaultdict(list)
+    if artifacts is None:
+        artifacts = [FINAL_ARTIFACT] * num_folds
+    # the same artifact is one shared model, it is run once per batch and its predictions count for every fold using it
+    counts = {}
+    for artifact in artifacts:
+        artifact = os.path.realpath(artifact)
+        counts[artifact] = counts.get(artifact, 0) + 1
+    models = [(REGISTRY.get(artifact), count) for artifact, count in counts.items()]
 
-    for fold in range(num_folds):
-        model = LeNet.restore("../models/LeNet_78_fold_None.mdl")
-        if torch.cuda.is_available():
-            model.cuda()
-        iterator = iter(loader)
-        iter_per_epoch = len(loader)
-        for _ in progressbar(range(iter_per_epoch)):
-            next_batch = next(iterator)
+    for ds in progressbar(_iter_datasets(path, chunk_size)):
+        loader = DataLoader(ds, 64)
+        for next_batch in loader:
             inputs_tensor, ids = next_batch["inputs"], next_batch["id"]
-            inputs = model.to_var(inputs_tensor)
-            probs, _ = model.predict(inputs, return_classes=False)
-            probs = model.to_np(probs).squeeze()
-            probs = probs.tolist()
-            chunk = dict(zip(ids, probs))
-            for k, v in chunk.items():
-                predictions[k].append(v)
+            for model, count in models:
+                inputs = model.to_var(inputs_tensor)
+                with torch.no_grad():
+                    probs, _ = model.predict(inputs, return_classes=False)
+                probs = model.to_np(probs).squeeze()
+                probs = probs.tolist()
+                chunk = dict(zip(ids, probs))
+                for k, v in chunk.items():
+                    predictions[k].extend([v] * count)
     if average:
         result = {k: sum(v) / len(v) for k, v in predictions.items()}
     else:
@@ -53,6 +78,8 @@ if __name__ == "__main__":
     original = "../data/orig/train.json"
     total_folds = 1
     epochs = [77, 70, 80, 80]
+    if not os.path.isfile(FINAL_ARTIFACT):
+        LeNet.export(FINAL_CHECKPOINT, FINAL_ARTIFACT)
     data = infer(original, total_folds, average=True)
 
     new_df = pd.DataFrame(list(data.items()), columns=["id", "is_iceberg"])
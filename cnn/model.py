@@ -2,6 +2,7 @@ import math
 import torch
 from torch import nn
 from base.model import BaseBinaryClassifier
+from base.stacked import stacked_layer, stacked_linear
 
 
 def conv3x3(in_planes, out_planes, stride=1):
@@ -92,7 +93,7 @@ class ResNet(BaseBinaryClassifier):
         x = self.layer2(x)
         x = self.layer3(x)
 
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.fc1(x)
         x = self.fc2(x)
         x = self.sigmoid(x)
@@ -130,13 +131,27 @@ class LeNet(BaseBinaryClassifier):
 
     def forward(self, x):
         out = self.feature_extractor(x)
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         out = self.fc1(out)
         out = self.activation(out)
         out = self.fc2(out)
         out = self.sigmoid(out)
         return out
 
+    @classmethod
+    def stacked_forward(cls, models, x, sizes=None):
+        # channels of all models side by side, convolutions become grouped ones
+        num_models, batch_size = x.size(0), x.size(1)
+        out = x.transpose(0, 1).reshape((batch_size, -1) + tuple(x.size()[3:]))
+        for layers in zip(*[m.feature_extractor for m in models]):
+            out = stacked_layer(out, layers, sizes)
+        out = out.reshape(batch_size, num_models, -1).transpose(0, 1)
+        out = stacked_linear(out, [m.fc1 for m in models])
+        out = models[0].activation(out)
+        out = stacked_linear(out, [m.fc2 for m in models])
+        out = models[0].sigmoid(out)
+        return out
+
 
 if __name__ == "__main__":
     net = LeNet(2, (64, 128, 128, 64), 512, 256)
@@ -0,0 +1,399 @@
+import os
+import json
+import time
+import fcntl
+import random
+import signal
+import socket
+import hashlib
+import multiprocessing
+from contextlib import contextmanager
+from base.exceptions import ProjectException
+from base.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+INTERRUPTED = "interrupted"
+
+
+def config_fingerprint(config):
+    """
+    Stable identifier of configuration. Unlike hash(str(config)) it is the same in every process
+    """
+    serialized = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def sample_configs(grid, rng):
+    """
+    Configurations of grid in random order without repetitions. Grid itself is never built,
+    random index into mixed radix product of value lists is decoded instead
+    :param rng: random.Random
+    """
+    keys = sorted(grid.keys())
+    sizes = [len(grid[k]) for k in keys]
+    total = 1
+    for size in sizes:
+        total *= size
+    seen = set()
+    while len(seen) < total:
+        index = rng.randrange(total)
+        if index in seen:
+            continue
+        seen.add(index)
+        config = {}
+        for key, size in zip(keys, sizes):
+            index, position = divmod(index, size)
+            config[key] = grid[key][position]
+        yield config
+
+
+@contextmanager
+def ignoring_sigint():
+    """
+    Processes started inside ignore SIGINT from the very beginning: ignored signals stay ignored in spawned
+    interpreters, so Ctrl+C while they start or unpickle arguments does not kill them.
+    Ctrl+C delivered to the main process meanwhile is lost
+    """
+    previous = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
+
+class TrialJournal:
+    """
+    Append-only JSONL store of search trials shared by all worker processes.
+    Every state change of trial is a new line, the last line of fingerprint wins.
+    Whole file is locked while trial is claimed, so two workers never run the same configuration.
+    Trials left "running" by dead processes of this host are stale and can be claimed again,
+    trials stopped by signal are released as "interrupted" and can be claimed again at once
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def _parse(cls, lines):
+        trials = {}
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # last line may be cut by killed process
+                continue
+            trials[record["fingerprint"]] = record
+        return trials
+
+    def _locked(self, action):
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                trials = self._parse(f.readlines())
+                result, records = action(trials)
+                for record in records:
+                    f.write(json.dumps(record, sort_keys=True) + "\n")
+                if records:
+                    f.flush()
+                    os.fsync(f.fileno())
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self):
+        if not os.path.isfile(self.path):
+            return {}
+        return self._locked(lambda trials: (trials, []))
+
+    @classmethod
+    def _record(cls, config, status, scores=None):
+        return {"fingerprint": config_fingerprint(config), "config": config, "status": status, "scores": scores,
+                "host": socket.gethostname(), "pid": os.getpid(), "time": time.time()}
+
+    @classmethod
+    def is_stale(cls, record):
+        return record["status"] == RUNNING and record["host"] == socket.gethostname() \
+            and not _pid_alive(record["pid"])
+
+    @classmethod
+    def is_taken(cls, record):
+        return record is not None and record["status"] in (RUNNING, DONE, FAILED) and not cls.is_stale(record)
+
+    def claim(self, config):
+        """
+        :return: True if configuration was not tried yet (or its worker died) and now belongs to this process
+        """
+        def action(trials):
+            if self.is_taken(trials.get(config_fingerprint(config))):
+                return False, []
+            return True, [self._record(config, RUNNING)]
+        return self._locked(action)
+
+    def finish(self, config, scores):
+        self._locked(lambda trials: (None, [self._record(config, DONE, scores)]))
+
+    def fail(self, config, error):
+        self._locked(lambda trials: (None, [self._record(config, FAILED, str(error))]))
+
+    def release(self, config):
+        """
+        Give up claimed trial which was not finished, e.g. because of signal. It is repeated by the next run
+        """
+        self._locked(lambda trials: (None, [self._record(config, INTERRUPTED)]))
+
+    def results(self):
+        return [r for r in self.read().values() if r["status"] == DONE]
+
+
+class RandomSearch:
+    """
+    Random search over parameter grid driven by TrialJournal. Search can run in several local processes
+    and be interrupted at any moment: finished trials are never repeated, unfinished ones are run again
+    """
+    def __init__(self, trainer, grid, journal_path="../data/search/trials.jsonl", seed=None):
+        self.trainer = trainer
+        self.grid = grid
+        self.journal = TrialJournal(journal_path)
+        self.seed = seed
+
+    def _next_config(self, candidates, trials):
+        """
+        :param candidates: generator of sample_configs, configurations taken by other workers are skipped for good
+        :param trials: journal read by the caller, claim() checks the latest state again under lock
+        """
+        for config in candidates:
+            if TrialJournal.is_taken(trials.get(config_fingerprint(config))):
+                continue
+            if self.journal.claim(config):
+                return config
+        return None
+
+    @classmethod
+    def _finished(cls, trials, iterations):
+        return sum(1 for t in trials.values() if TrialJournal.is_taken(t)) >= iterations
+
+    def work(self, iterations, epochs, transformations, worker_id=0, fold_workers=1, stop=lambda: False):
+        """
+        Run trials until journal holds `iterations` finished or running trials or grid is exhausted
+        """
+        rng = random.Random(None if self.seed is None else self.seed + worker_id)
+        candidates = sample_configs(self.grid, rng)
+        while not stop():
+            # journal is read once per trial, other workers may have changed it meanwhile
+            trials = self.journal.read()
+            if self._finished(trials, iterations):
+                break
+            config = self._next_config(candidates, trials)
+            if config is None:
+                print("All configurations of grid were tried!")
+                break
+            print("Worker %s, next config %s" % (worker_id, config))
+            try:
+                scores = self.trainer.train_one_configuration(config, epochs, transformations, fold_workers)
+            except ProjectException as e:
+                self.journal.fail(config, e)
+                continue
+            except BaseException:
+                self.journal.release(config)
+                raise
+            if stop():
+                # trial was cut by signal, it is released and repeated on resume, also by this process
+                self.journal.release(config)
+                break
+            self.journal.finish(config, scores)
+
+    def run(self, iterations, epochs, transformations, workers=1, fold_workers=1, result_path="../data/results.csv"):
+        """
+        :param iterations: total number of trials in journal, already finished ones count too
+        :param workers: number of local processes pulling trials from journal
+        :param fold_workers: number of processes training folds of one trial, see ModelTrainer
+        """
+        self.trainer._searching = True
+        try:
+            if workers == 1:
+                self.work(iterations, epochs, transformations, fold_workers=fold_workers,
+                          stop=lambda: self.trainer._kill)
+            else:
+                self._run_workers(iterations, epochs, transformations, workers, fold_workers)
+        finally:
+            self.trainer._searching = False
+        return self.save_results(result_path)
+
+    def _run_workers(self, iterations, epochs, transformations, workers, fold_workers):
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=_search_worker,
+                                     args=(self, iterations, epochs, transformations, i, fold_workers))
+                     for i in range(workers)]
+        with ignoring_sigint():
+            for process in processes:
+                process.start()
+        # workers share stop event of trainer: on signal they finish the current epoch, release their trials
+        # and exit with their fold processes, nothing is terminated
+        reported = False
+        while any(p.is_alive() for p in processes):
+            if self.trainer._kill and not reported:
+                print("Stopping search workers after the current epoch because of signal!")
+                reported = True
+            time.sleep(1)
+        for process in processes:
+            process.join()
+
+    def save_results(self, path):
+        rows = []
+        for trial in self.journal.results():
+            rows.append(list(trial["scores"]) + [str(trial["config"]), trial["fingerprint"]])
+        results = pd.DataFrame(rows)
+        results.to_csv(path, index=False)
+        print("Results are saved to path %s" % path)
+        return rows
+
+
+def _search_worker(search, iterations, epochs, transformations, worker_id, fold_workers):
+    # only main process handles Ctrl+C, workers see it through stop event of trainer and release their trials
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    search.work(iterations, epochs, transformations, worker_id=worker_id, fold_workers=fold_workers,
+                stop=lambda: search.trainer._kill)
+
+
+class ASHAScheduler:
+    """
+    Asynchronous successive halving on top of ModelTrainer.
+    Rungs are epoch budgets min_epochs * reduction_factor ** k up to max_epochs. Every new configuration is trained
+    on all folds up to the first rung. Configuration is promoted to the next rung as soon as its mean of best fold
+    val_loss is in the top 1 / reduction_factor of the results of its rung, the others are never trained further.
+    Promoted configurations continue from fold checkpoints saved at the end of previous rung.
+    With `stacked` all folds of rung are trained at once, see ModelTrainer._train_folds_stacked
+    """
+    def __init__(self, trainer, grid, min_epochs=5, max_epochs=100, reduction_factor=3,
+                 checkpoint_directory="../models/asha", seed=None, stacked=False):
+        self.trainer = trainer
+        self.stacked = stacked
+        self.grid = grid
+        self.reduction_factor = reduction_factor
+        self.checkpoint_directory = checkpoint_directory
+        self.rng = random.Random(seed)
+        # configurations are drawn lazily, so huge grids cost nothing upfront
+        self._candidates = sample_configs(grid, self.rng)
+        self.rungs = []
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.rungs.append(epochs)
+            epochs *= reduction_factor
+        self.rungs.append(max_epochs)
+        self.results = [{} for _ in self.rungs]      # fingerprint -> mean of best fold losses
+        self.promoted = [set() for _ in self.rungs]
+        self.configs = {}
+        self.fold_best = {}
+
+    def _checkpoint_path(self, fingerprint, fold):
+        return os.path.join(self.checkpoint_directory, "%s_fold_%s.mdl" % (fingerprint, fold))
+
+    def _get_promotable(self):
+        # the highest rung first, so good configurations reach full budget early
+        for rung in reversed(range(len(self.rungs) - 1)):
+            finished = self.results[rung]
+            top = sorted(finished, key=finished.get)[:len(finished) // self.reduction_factor]
+            for fingerprint in top:
+                if fingerprint not in self.promoted[rung]:
+                    return fingerprint, rung
+        return None
+
+    def _get_new_config(self):
+        for config in self._candidates:
+            if config_fingerprint(config) not in self.configs:
+                return config
+        return None
+
+    def _get_callback(self, fingerprint, fold, stop_epoch):
+        def callback(model, optim, epoch, stats):
+            if epoch + 1 == stop_epoch:
+                model.save(self._checkpoint_path(fingerprint, fold), optim, False, scores=stats)
+            return not self.trainer._kill
+        return callback
+
+    def _run_rung(self, config, rung, transformations):
+        fingerprint = config_fingerprint(config)
+        start_epoch = self.rungs[rung - 1] if rung > 0 else 0
+        fold_best = self.fold_best.setdefault(fingerprint, [float("inf")] * self.trainer.num_folds)
+        if self.stacked:
+            checkpoints = [self._checkpoint_path(fingerprint, fold) for fold in range(self.trainer.num_folds)]
+            callbacks = [self._get_callback(fingerprint, fold, self.rungs[rung])
+                         for fold in range(self.trainer.num_folds)]
+            best = self.trainer._train_folds_stacked(config, self.rungs[rung], transformations,
+                                                     start_epoch=start_epoch,
+                                                     checkpoints=checkpoints if rung > 0 else None,
+                                                     epoch_callbacks=callbacks)
+            if self.trainer._kill:
+                return None
+            fold_best[:] = [min(old, new) for old, new in zip(fold_best, best)]
+        else:
+            for fold in range(self.trainer.num_folds):
+                checkpoint = self._checkpoint_path(fingerprint, fold) if rung > 0 else None
+                best = self.trainer._train_fold(config, self.rungs[rung], transformations, fold,
+                                                start_epoch=start_epoch, checkpoint=checkpoint,
+                                                epoch_callback=self._get_callback(fingerprint, fold,
+                                                                                  self.rungs[rung]))
+                if self.trainer._kill:
+                    return None
+                fold_best[fold] = min(fold_best[fold], best)
+        loss = sum(fold_best) / len(fold_best)
+        self.results[rung][fingerprint] = loss
+        print("Config %s reached %s epochs with loss %s" % (config, self.rungs[rung], loss))
+        return loss
+
+    def run(self, max_trials, transformations, result_path="../data/asha_results.csv"):
+        """
+        :param max_trials: number of configurations started at the first rung
+        :return: rows of (mean of best fold losses, epochs trained, config, fingerprint), best first
+        """
+        os.makedirs(self.checkpoint_directory, exist_ok=True)
+        self.trainer._searching = True
+        try:
+            while not self.trainer._kill:
+                promotable = self._get_promotable()
+                if promotable is not None:
+                    fingerprint, rung = promotable
+                    self.promoted[rung].add(fingerprint)
+                    self._run_rung(self.configs[fingerprint], rung + 1, transformations)
+                    continue
+                config = self._get_new_config() if len(self.configs) < max_trials else None
+                if config is None:
+                    break
+                self.configs[config_fingerprint(config)] = config
+                self._run_rung(config, 0, transformations)
+        finally:
+            self.trainer._searching = False
+        return self.save_results(result_path)
+
+    def save_results(self, path):
+        rows = []
+        for fingerprint, config in self.configs.items():
+            reached = [r for r in range(len(self.rungs)) if fingerprint in self.results[r]]
+            if reached:
+                rows.append([self.results[reached[-1]][fingerprint], self.rungs[reached[-1]], str(config),
+                             fingerprint])
+        rows.sort(key=lambda row: (-row[1], row[0]))
+        pd.DataFrame(rows).to_csv(path, index=False)
+        print("Results are saved to path %s" % path)
+        return rows
@@ -1,16 +1,24 @@
 import numpy as np
 from base.dataset import BaseDataset
+from cnn.store import IcebergStore
 
 
 class SimpleIcebergDataset(BaseDataset):
     def __init__(self, path, inference_only=False, transform=None):
-        data = np.load(path)
         self.transform = transform
-        if not inference_only:
-            self.x = data[:, : -1]
-            self.y = data[:, -1]
+        if isinstance(path, IcebergStore) or IcebergStore.is_store(path):
+            store = path if isinstance(path, IcebergStore) else IcebergStore.open(path)
+            # flat float32 view of memory mapped bands, no copy is made here
+            self.x = store.bands.reshape(len(store), -1)
+            if store.has_labels:
+                self.y = store.labels
         else:
-            self.x = data
+            data = np.load(path, mmap_mode="r")
+            if not inference_only:
+                self.x = data[:, : -1]
+                self.y = data[:, -1]
+            else:
+                self.x = data
 
     def __len__(self):
         length = self.x.shape[0]
@@ -18,7 +26,7 @@ class SimpleIcebergDataset(BaseDataset):
 
     def __getitem__(self, idx):
         y = np.array([self.y[idx]])
-        x = self.x[idx, :]
+        x = np.array(self.x[idx, :])
         item = {"targets": y, "inputs": x}
         if self.transform:
             item = self.transform(item)
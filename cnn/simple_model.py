@@ -1,5 +1,6 @@
 from torch import nn
 from base.model import BaseBinaryClassifier
+from base.stacked import stacked_linear
 
 
 class SimpleMLP(BaseBinaryClassifier):
@@ -24,6 +25,14 @@ class SimpleMLP(BaseBinaryClassifier):
         out = self.sigmoid(out)
         return out
 
+    @classmethod
+    def stacked_forward(cls, models, x, sizes=None):
+        out = stacked_linear(x, [m.fc1 for m in models])
+        out = models[0].activation(out)
+        out = stacked_linear(out, [m.fc2 for m in models])
+        out = models[0].sigmoid(out)
+        return out
+
 
 if __name__ == "__main__":
     def train():
@@ -0,0 +1,142 @@
+import json
+import numpy as np
+from tqdm import tqdm as progressbar
+from base.exceptions import ProjectException
+from cnn.store import IcebergStore, iter_chunks
+
+
+STATS_VERSION = 1
+
+
+class BandStatistics:
+    """
+    Single pass, chunked statistics of image bands.
+    Min / max are exact, mean / std are merged per chunk with Welford (Chan et al.) update,
+    quantiles are interpolated from fixed-bin histogram with resolution (high - low) / bins
+    """
+    def __init__(self, num_bands=2, low=-100.0, high=100.0, bins=200000):
+        self.num_bands = num_bands
+        self.low = low
+        self.high = high
+        self.bins = bins
+        self.count = 0
+        self.minimum = np.full(num_bands, np.inf)
+        self.maximum = np.full(num_bands, -np.inf)
+        self.mean = np.zeros(num_bands)
+        self.m2 = np.zeros(num_bands)
+        # two extra bins count values below low and above high
+        self.histogram = np.zeros((num_bands, bins + 2), dtype=np.int64)
+
+    def update(self, bands):
+        """
+        :param bands: array of shape (N, num_bands, H, W)
+        """
+        values = np.asarray(bands, dtype=np.float64).swapaxes(0, 1).reshape(self.num_bands, -1)
+        chunk_count = values.shape[1]
+        if chunk_count == 0:
+            return self
+        chunk_mean = values.mean(axis=1)
+        chunk_m2 = ((values - chunk_mean[:, None]) ** 2).sum(axis=1)
+        total = self.count + chunk_count
+        delta = chunk_mean - self.mean
+        self.mean += delta * chunk_count / total
+        self.m2 += chunk_m2 + delta ** 2 * self.count * chunk_count / total
+        self.count = total
+
+        self.minimum = np.minimum(self.minimum, values.min(axis=1))
+        self.maximum = np.maximum(self.maximum, values.max(axis=1))
+
+        bin_width = (self.high - self.low) / self.bins
+        positions = np.floor((values - self.low) / bin_width).astype(np.int64) + 1
+        np.clip(positions, 0, self.bins + 1, out=positions)
+        for band in range(self.num_bands):
+            self.histogram[band] += np.bincount(positions[band], minlength=self.bins + 2)
+        return self
+
+    @property
+    def std(self):
+        # population std, same as np.std
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def quantile(self, q):
+        bin_width = (self.high - self.low) / self.bins
+        result = np.zeros(self.num_bands)
+        for band in range(self.num_bands):
+            cumulative = np.cumsum(self.histogram[band])
+            target = q * self.count
+            position = int(np.searchsorted(cumulative, target, side="left"))
+            if position == 0:
+                result[band] = self.minimum[band]
+            elif position == self.bins + 1:
+                result[band] = self.maximum[band]
+            else:
+                before = cumulative[position - 1]
+                in_bin = self.histogram[band, position]
+                fraction = (target - before) / in_bin if in_bin else 0.0
+                result[band] = self.low + (position - 1 + fraction) * bin_width
+        return result
+
+    def result(self, source=None):
+        median = self.quantile(0.5)
+        q1 = self.quantile(0.25)
+        q3 = self.quantile(0.75)
+        std = self.std
+        stats = {
+            "version": STATS_VERSION,
+            "source": source,
+            "count": int(self.count),
+            "min_max": {"min1": self.minimum[0], "min2": self.minimum[1],
+                        "max1": self.maximum[0], "max2": self.maximum[1]},
+            "mu_sigma": {"mu1": self.mean[0], "mu2": self.mean[1], "sigma1": std[0], "sigma2": std[1]},
+            "med_q": {"med1": median[0], "med2": median[1], "q1_1": q1[0], "q1_2": q1[1],
+                      "q3_1": q3[0], "q3_2": q3[1]},
+        }
+        for key in ("min_max", "mu_sigma", "med_q"):
+            stats[key] = {k: float(v) for k, v in stats[key].items()}
+        return stats
+
+
+def _iter_bands(path, chunk_size):
+    if isinstance(path, IcebergStore) or IcebergStore.is_store(path):
+        store = path if isinstance(path, IcebergStore) else IcebergStore.open(path)
+        for start in range(0, len(store), chunk_size):
+            yield store.bands[start: start + chunk_size]
+    else:
+        for chunk in iter_chunks(path, chunk_size=chunk_size):
+            yield chunk.bands
+
+
+def profile(path, chunk_size=512, **kwargs):
+    """
+    Compute band statistics of dataset in one pass without holding it in memory
+    :param path: IcebergStore, path to store directory or to json file
+    :param chunk_size: number of images processed at once
+    :return: dictionary with "min_max", "mu_sigma" and "med_q" scaler params
+    """
+    engine = BandStatistics(**kwargs)
+    for bands in progressbar(_iter_bands(path, chunk_size)):
+        engine.update(bands)
+    source = path.directory if isinstance(path, IcebergStore) else path
+    return engine.result(source=source)
+
+
+def save_stats(stats, path):
+    with open(path, "w") as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
+    print("Stats are saved to path %s" % path)
+
+
+def load_stats(path):
+    with open(path, "r") as f:
+        stats = json.load(f)
+    if stats.get("version") != STATS_VERSION:
+        raise ProjectException("Stats file %s has version %s, expected %s. Profile data again!"
+                               % (path, stats.get("version"), STATS_VERSION))
+    return stats
+
+
+if __name__ == "__main__":
+    result = profile("../data/store/train")
+    print(result)
+    save_stats(result, "../data/store/train_stats.json")
+    print("Finished!")
@@ -0,0 +1,392 @@
+import os
+import json
+import errno
+import atexit
+import shutil
+import tempfile
+import numpy as np
+from base.exceptions import ProjectException
+from base.lazy import lazy_import
+
+model_selection = lazy_import("sklearn.model_selection")
+
+
+WIDTH = 75  # according to dataset each "picture" is unrolled 75 * 75 "image"
+BANDS_FILE = "bands.npy"
+ANGLE_FILE = "angle.npy"
+ANGLE_MASK_FILE = "angle_mask.npy"
+LABELS_FILE = "labels.npy"
+IDS_FILE = "ids.npy"
+FOLD_TRAIN_FILE = "train_%s.npy"
+FOLD_TEST_FILE = "test_%s.npy"
+SHARED_MEMORY = "/dev/shm"
+# shared memory left free for others, e.g. batches which DataLoader workers send through it
+SHARED_MEMORY_RESERVE = 256 * 1024 ** 2
+
+
+class IcebergStore:
+    """
+    Columnar binary representation of train.json / test.json.
+    bands: float32 (N, 2, width, width), angle: float32 (N,) with NaN for missing values,
+    angle_mask: bool (N,) True where angle was missing, labels: float32 (N,) or None, ids: unicode (N,)
+    """
+    def __init__(self, bands, angle, ids, labels=None, angle_mask=None, directory=None):
+        self.bands = bands
+        self.angle = angle
+        self.ids = ids
+        self.labels = labels
+        self.angle_mask = angle_mask if angle_mask is not None else np.isnan(angle)
+        self.directory = directory
+        # directory was created by share() of this process and is removed by close()
+        self.shared = False
+
+    def __len__(self):
+        return self.bands.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getstate__(self):
+        # stores on disk are pickled by path (e.g. for spawned workers) and reopened memory mapped
+        if self.directory is not None:
+            return {"directory": self.directory}
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if "bands" not in state:
+            state = IcebergStore.open(state["directory"]).__dict__
+        self.__dict__.update(state)
+
+    @property
+    def has_labels(self):
+        return self.labels is not None
+
+    @classmethod
+    def is_store(cls, path):
+        return isinstance(path, str) and os.path.isfile(os.path.join(path, BANDS_FILE))
+
+    @classmethod
+    def open(cls, directory, mmap_mode="r"):
+        if not cls.is_store(directory):
+            raise ProjectException("Directory %s does not contain converted dataset!" % directory)
+        bands = np.load(os.path.join(directory, BANDS_FILE), mmap_mode=mmap_mode)
+        angle = np.load(os.path.join(directory, ANGLE_FILE), mmap_mode=mmap_mode)
+        angle_mask = np.load(os.path.join(directory, ANGLE_MASK_FILE), mmap_mode=mmap_mode)
+        ids = np.load(os.path.join(directory, IDS_FILE), mmap_mode=mmap_mode)
+        labels = None
+        labels_path = os.path.join(directory, LABELS_FILE)
+        if os.path.isfile(labels_path):
+            labels = np.load(labels_path, mmap_mode=mmap_mode)
+        return cls(bands, angle, ids, labels=labels, angle_mask=angle_mask, directory=directory)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, BANDS_FILE), np.ascontiguousarray(self.bands, dtype=np.float32))
+        np.save(os.path.join(directory, ANGLE_FILE), np.asarray(self.angle, dtype=np.float32))
+        np.save(os.path.join(directory, ANGLE_MASK_FILE), np.asarray(self.angle_mask, dtype=np.bool_))
+        np.save(os.path.join(directory, IDS_FILE), np.asarray(self.ids, dtype=np.str_))
+        if self.has_labels:
+            np.save(os.path.join(directory, LABELS_FILE), np.asarray(self.labels, dtype=np.float32))
+        return directory
+
+    def share(self, directory=None):
+        """
+        Move in memory store to shared memory (/dev/shm if it has room for the store, temporary directory otherwise)
+        and reopen it read-only memory mapped. Forked DataLoader workers then read the same physical pages,
+        so memory used by all workers together stays about the size of the data.
+        Files are removed by close() of returned store, or when the process which shared the store exits
+        :return: memory mapped IcebergStore
+        """
+        if self.directory is not None:
+            return self
+        return IcebergStore._open_shared(_save_shared(self.save, self.nbytes, directory))
+
+    @classmethod
+    def _open_shared(cls, directory):
+        store = cls.open(directory)
+        store.shared = True
+        atexit.register(store.close)
+        return store
+
+    @property
+    def nbytes(self):
+        arrays = (self.bands, self.angle, self.ids, self.labels, self.angle_mask)
+        return sum(np.asarray(a).nbytes for a in arrays if a is not None)
+
+    def close(self):
+        """
+        Remove shared memory files of store made by share(). Memory is returned to the system
+        when the last memory map of them (e.g. in DataLoader workers) is released.
+        Stores opened from disk are not removed
+        """
+        if not self.shared:
+            return
+        self.shared = False
+        atexit.unregister(self.close)
+        shutil.rmtree(self.directory, True)
+
+
+def _has_room(directory, size):
+    if not os.path.isdir(directory):
+        return False
+    stats = os.statvfs(directory)
+    return stats.f_bavail * stats.f_frsize >= size + SHARED_MEMORY_RESERVE
+
+
+def _save_shared(save, size, directory=None):
+    """
+    Call save(target) with new temporary directory target: inside `directory` if given, otherwise in shared memory
+    if it has room for `size` bytes and in default temporary directory if it has not.
+    Shared memory may be filled by others meanwhile (e.g. small /dev/shm of docker containers),
+    then saving is repeated in default temporary directory.
+    Files are written, never memory mapped, so lack of space is ENOSPC error instead of SIGBUS
+    :return: target directory
+    """
+    if directory is not None:
+        parents = [directory]
+    else:
+        parents = ([SHARED_MEMORY] if _has_room(SHARED_MEMORY, size) else []) + [None]
+    for i, parent in enumerate(parents):
+        target = tempfile.mkdtemp(prefix="iceberg_store_", dir=parent)
+        try:
+            save(target)
+            return target
+        except OSError as e:
+            shutil.rmtree(target, True)
+            if e.errno != errno.ENOSPC or i == len(parents) - 1:
+                raise
+            print("Not enough shared memory for %s bytes, store is saved to %s" % (size, tempfile.gettempdir()))
+        except BaseException:
+            shutil.rmtree(target, True)
+            raise
+
+
+def iter_records(path, read_size=1 << 20):
+    """
+    Parse json array of records incrementally. Only one record and a read buffer are kept in memory
+    :param path: path to json file containing array of objects
+    :param read_size: number of characters read from file at once
+    :return: generator of dictionaries
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    opened = False
+    with open(path, "r") as source:
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or buffer[position] == ","):
+                position += 1
+            if position == len(buffer):
+                buffer = source.read(read_size)
+                position = 0
+                if not buffer:
+                    raise ProjectException("Unexpected end of file %s" % path)
+                continue
+            if not opened:
+                if buffer[position] != "[":
+                    raise ProjectException("File %s does not contain json array!" % path)
+                opened = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # record is not complete yet, read the next part of file and try again
+                chunk = source.read(read_size)
+                if not chunk:
+                    raise ProjectException("Unexpected end of file %s" % path)
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield record
+
+
+def parse_angle(value):
+    # missing angles are stored as "na" strings in original data
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def iter_chunks(path, chunk_size=512, width=WIDTH):
+    """
+    Read json file in fixed size chunks of float32 arrays
+    :param path: path to train.json or test.json
+    :param chunk_size: number of records in one chunk, last chunk may be smaller
+    :param width: width of image
+    :return: generator of in memory IcebergStore objects holding ids, bands, angle (and labels if present)
+    """
+    ids, angle, labels = [], [], []
+    bands = np.empty((chunk_size, 2, width, width), dtype=np.float32)
+    for record in iter_records(path):
+        i = len(ids)
+        bands[i, 0] = np.reshape(record["band_1"], (width, width))
+        bands[i, 1] = np.reshape(record["band_2"], (width, width))
+        ids.append(record["id"])
+        angle.append(parse_angle(record["inc_angle"]))
+        if "is_iceberg" in record:
+            labels.append(record["is_iceberg"])
+        if len(ids) == chunk_size:
+            yield _make_chunk(bands, angle, ids, labels)
+            ids, angle, labels = [], [], []
+            bands = np.empty((chunk_size, 2, width, width), dtype=np.float32)
+    if ids:
+        yield _make_chunk(bands[:len(ids)], angle, ids, labels)
+
+
+def _make_chunk(bands, angle, ids, labels):
+    labels = np.array(labels, dtype=np.float32) if labels else None
+    return IcebergStore(bands, np.array(angle, dtype=np.float32), np.array(ids, dtype=np.str_), labels=labels)
+
+
+def from_legacy(data, width=WIDTH, has_labels=True):
+    """
+    Convert object array produced by old versions of general.misc.split (rows of band_1, band_2, inc_angle
+    and is_iceberg) to in memory IcebergStore with flat float32 buffers
+    """
+    length = data.shape[0]
+    bands = np.empty((length, 2, width, width), dtype=np.float32)
+    for i in range(length):
+        bands[i, 0] = np.reshape(data[i, 0], (width, width))
+        bands[i, 1] = np.reshape(data[i, 1], (width, width))
+    angle = np.array([parse_angle(a) for a in data[:, 2]], dtype=np.float32)
+    ids = np.array([str(i) for i in range(length)], dtype=np.str_)
+    labels = np.asarray(data[:, -1], dtype=np.float32) if has_labels else None
+    return IcebergStore(bands, angle, ids, labels=labels)
+
+
+def read_ids(path):
+    ids = [record["id"] for record in iter_records(path)]
+    return np.array(ids, dtype=np.str_)
+
+
+def load_json(path, chunk_size=512, width=WIDTH):
+    """
+    Read json file to in memory IcebergStore. Memory usage is bounded by size of float32 arrays,
+    parsed json is never held as a whole
+    """
+    chunks = list(iter_chunks(path, chunk_size, width))
+    if not chunks:
+        raise ProjectException("No records found in %s" % path)
+    bands = np.concatenate([c.bands for c in chunks])
+    angle = np.concatenate([c.angle for c in chunks])
+    ids = np.concatenate([c.ids for c in chunks])
+    labels = None
+    if all(c.has_labels for c in chunks):
+        labels = np.concatenate([c.labels for c in chunks])
+    return IcebergStore(bands, angle, ids, labels=labels)
+
+
+def _spool_json(json_path, raw_path, chunk_size=512, width=WIDTH):
+    """
+    Write bands of json file chunk by chunk to raw float32 file, their number is unknown until the end
+    :return: number of records, angle, ids, labels (None unless every record has label)
+    """
+    angles, ids, labels = [], [], []
+    with open(raw_path, "wb") as raw:
+        for chunk in iter_chunks(json_path, chunk_size, width):
+            raw.write(chunk.bands.tobytes())
+            angles.append(chunk.angle)
+            ids.append(chunk.ids)
+            if chunk.has_labels:
+                labels.append(chunk.labels)
+    length = sum(a.shape[0] for a in angles)
+    if length == 0:
+        raise ProjectException("No records found in %s" % json_path)
+    labels = np.concatenate(labels) if len(labels) == len(angles) else None
+    return length, np.concatenate(angles), np.concatenate(ids), labels
+
+
+def _write_spooled(raw_path, directory, length, angle, ids, labels, width=WIDTH):
+    # bands are copied from raw file behind .npy header with plain writes, nothing is held in memory
+    os.makedirs(directory, exist_ok=True)
+    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)), "fortran_order": False,
+              "shape": (length, 2, width, width)}
+    with open(os.path.join(directory, BANDS_FILE), "wb") as bands, open(raw_path, "rb") as raw:
+        np.lib.format.write_array_header_1_0(bands, header)
+        shutil.copyfileobj(raw, bands, 1 << 20)
+    np.save(os.path.join(directory, ANGLE_FILE), angle)
+    np.save(os.path.join(directory, ANGLE_MASK_FILE), np.isnan(angle))
+    np.save(os.path.join(directory, IDS_FILE), ids)
+    if labels is not None:
+        np.save(os.path.join(directory, LABELS_FILE), labels)
+
+
+def convert(json_path, directory, width=WIDTH, chunk_size=512):
+    """
+    One-time conversion of original json file to IcebergStore directory.
+    Json is streamed, bands are written to disk chunk by chunk
+    :param json_path: path to train.json or test.json
+    :param directory: output directory
+    :return: IcebergStore opened in read only memory mapped mode
+    """
+    os.makedirs(directory, exist_ok=True)
+    raw_path = os.path.join(directory, BANDS_FILE + ".raw")
+    try:
+        length, angle, ids, labels = _spool_json(json_path, raw_path, chunk_size, width)
+        _write_spooled(raw_path, directory, length, angle, ids, labels, width)
+    finally:
+        if os.path.isfile(raw_path):
+            os.remove(raw_path)
+    print("Converted %s records from %s to %s" % (length, json_path, directory))
+    return IcebergStore.open(directory)
+
+
+def share_json(json_path, directory=None, width=WIDTH, chunk_size=512):
+    """
+    Stream json file straight to shared memory store, see IcebergStore.share. Memory usage stays flat:
+    bands are spooled to temporary file on disk first, then copied to shared memory once their size is known
+    :return: memory mapped IcebergStore, its files are removed by close()
+    """
+    spool = tempfile.mkdtemp(prefix="iceberg_spool_")
+    raw_path = os.path.join(spool, BANDS_FILE + ".raw")
+    try:
+        length, angle, ids, labels = _spool_json(json_path, raw_path, chunk_size, width)
+        size = os.path.getsize(raw_path) + angle.nbytes * 2 + ids.nbytes
+        target = _save_shared(lambda target: _write_spooled(raw_path, target, length, angle, ids, labels, width),
+                              size, directory)
+    finally:
+        shutil.rmtree(spool, True)
+    return IcebergStore._open_shared(target)
+
+
+def make_folds(store, directory, n_splits=4):
+    """
+    Split store to stratified folds. Each fold is saved as two small int64 index arrays over the store rows
+    :param store: IcebergStore or path to it
+    :param directory: output directory for index files
+    :return: list of (train_indices, test_indices) tuples
+    """
+    store = store if isinstance(store, IcebergStore) else IcebergStore.open(store)
+    if not store.has_labels:
+        raise ProjectException("Cannot make stratified folds without labels!")
+    os.makedirs(directory, exist_ok=True)
+    labels = np.asarray(store.labels)
+    # no shuffling, folds keep the same rows as the ones produced from json by general.misc before
+    stk = model_selection.StratifiedKFold(n_splits=n_splits)
+    result = []
+    for fold, (train, test) in enumerate(stk.split(np.zeros(len(labels)), labels)):
+        train, test = train.astype(np.int64), test.astype(np.int64)
+        np.save(os.path.join(directory, FOLD_TRAIN_FILE % fold), train)
+        np.save(os.path.join(directory, FOLD_TEST_FILE % fold), test)
+        result.append((train, test))
+    return result
+
+
+def load_fold(directory, fold):
+    train = np.load(os.path.join(directory, FOLD_TRAIN_FILE % fold))
+    test = np.load(os.path.join(directory, FOLD_TEST_FILE % fold))
+    return train, test
+
+
+if __name__ == "__main__":
+    convert("../data/orig/train.json", "../data/store/train")
+    convert("../data/orig/test.json", "../data/store/test")
+    make_folds("../data/store/train", "../data/folds", n_splits=4)
+    print("Finished!")
@@ -1,23 +1,35 @@
+import os
+import queue
 import signal
-import pandas as pd
+import multiprocessing
 import torch
 from torch import nn
 from base.logger import Logger
+from base.loader import InMemoryLoader, seed_worker
+from base.stacked import ModelStack
+from base.exceptions import ProjectException
 from torch.nn import functional as F
 from cnn.dataset import IcebergDataset, ToTensor, Flip, Rotate, Ravel
+from cnn.store import IcebergStore, load_fold
+from cnn.batch_transforms import BatchCollate, BatchDihedral, BatchNoise
+from cnn.search import RandomSearch, ASHAScheduler, config_fingerprint, ignoring_sigint
 from cnn.model import LeNet
 from cnn.inception import Inception
 from cnn.auto_encoder import VariationalAutoEncoder
 from cnn.aenc_dataset import AutoEncoderDataset
 from torch.utils.data import DataLoader, ConcatDataset
-from torchvision import transforms
-from random import choice
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm as progressbar
+from base.lazy import lazy_import
+
+transforms = lazy_import("torchvision.transforms")
 
 
 class ModelTrainer:
     def __init__(self, num_feature_planes, model_class, loss_fn, num_folds, logger_class,
-                 train_top=None, test_top=None):
+                 train_top=None, test_top=None, data_path="../data/store/train", folds_path="../data/folds",
+                 batch_transform=None, in_memory=False, num_workers=12, histogram_writer=None,
+                 checkpoint_manager=None):
         self.model_class = model_class
         self.loss_func = loss_fn
         self.num_folds = num_folds
@@ -25,57 +37,255 @@ class ModelTrainer:
         self.logger_class = logger_class
         self.train_top = train_top
         self.test_top = test_top
-        self._cache = {}        # used to keep track of tried configurations
-
-        self._kill = False
+        # dataset is opened once memory mapped, folds are index arrays over it
+        self.store = IcebergStore.open(data_path)
+        self.folds_path = folds_path
+        # augmentation applied to whole collated training batch, e.g. BatchDihedral
+        self.batch_transform = batch_transform
+        # keep whole dataset in (gpu) memory and iterate it without DataLoader workers
+        self.in_memory = in_memory
+        self._preloaded = None
+        # DataLoader workers of training set, validation set gets half of them (none if 0)
+        self.num_workers = num_workers
+        # AsyncHistogramWriter shared by all models, histograms are written synchronously if None
+        self.histogram_writer = histogram_writer
+        # CheckpointManager shared by all models, every epoch is saved synchronously if None
+        self.checkpoint_manager = checkpoint_manager
+
+        # set on signal during search. Processes of search and of folds get the same event with the trainer,
+        # so all of them stop after the current epoch
+        self._stop = multiprocessing.get_context("spawn").Event()
         self._searching = False
         signal.signal(signal.SIGINT, self._exit_gracefully)
 
+    @property
+    def _kill(self):
+        return self._stop.is_set()
+
+    def __getstate__(self):
+        # trainer is sent to fold worker processes, preloaded tensors are loaded there again
+        state = self.__dict__.copy()
+        state["_preloaded"] = None
+        return state
+
     def _exit_gracefully(self, signum, frame):
         print("Got signal number %s. Will stop as soon as possible!" % signum)
         if self._searching:
-            self._kill = True
+            self._stop.set()
         else:
             print("Exiting now!")
             exit(2)
 
-    def _get_random_config(self, config, verbose=True):
-        generated = False
-        res = None
-        while not generated:
-            res = {k: choice(v) for k, v in config.items()}
-            key = hash(str(res))
-            if key not in self._cache.keys():
-                generated = True
-                self._cache[key] = res
-        if verbose:
-            print("Next config, ", res)
-        return res
+    def _get_train_loader(self, dataset, batch_size):
+        collate_fn = default_collate
+        if self.batch_transform is not None:
+            collate_fn = BatchCollate(self.batch_transform)
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=self.num_workers, pin_memory=True,
+                            shuffle=True, collate_fn=collate_fn)
+        return loader
+
+    def _preload(self):
+        # store is read once, all folds and configurations slice the same tensors
+        if self._preloaded is None:
+            dataset = IcebergDataset(self.store, transform=ToTensor(), add_feature_planes="no")
+            self._preloaded = InMemoryLoader.preload(dataset)
+        return self._preloaded
+
+    def _get_in_memory_loaders(self, config, train_indices, val_indices):
+        inputs, targets = self._preload()
+        train_rows = torch.arange(len(self.store)) if train_indices is None else torch.from_numpy(train_indices)
+        val_rows = torch.from_numpy(val_indices)
+        if self.train_top:
+            train_rows = train_rows[:self.train_top]
+        if self.test_top:
+            val_rows = val_rows[:self.test_top]
+        train_loader = InMemoryLoader(inputs, targets, config["train_batch_size"], shuffle=True, indices=train_rows,
+                                      batch_transform=self.batch_transform)
+        val_loader = InMemoryLoader(inputs, targets, config["test_batch_size"], indices=val_rows)
+        return train_loader, val_loader
+
+    def _get_loaders(self, config, transformations, train_indices, val_indices):
+        """
+        :param train_indices: rows of store used for training, None means the whole store
+        :param val_indices: rows of store used for validation
+        """
+        if self.in_memory:
+            if not isinstance(transformations, ToTensor):
+                raise ProjectException("Only batch_transform is applied in memory, use ToTensor as transformations!")
+            return self._get_in_memory_loaders(config, train_indices, val_indices)
+        train_set = IcebergDataset(self.store, transform=transformations, top=self.train_top,
+                                   add_feature_planes="no", indices=train_indices)
+        val_ds = IcebergDataset(self.store, transform=ToTensor(), top=self.test_top,
+                                add_feature_planes="no", indices=val_indices)
+        train_loader = self._get_train_loader(train_set, config["train_batch_size"])
+        # no worker processes for validation either if training set is loaded in main process
+        val_workers = max(self.num_workers // 2, 1) if self.num_workers else 0
+        val_loader = DataLoader(val_ds, batch_size=config["test_batch_size"], num_workers=val_workers,
+                                pin_memory=True)
+        return train_loader, val_loader
 
     def train_all(self, config, epochs, transformations):
         main_logger = self.logger_class("../logs", erase_folder_content=False)
         net = self.model_class(self.num_feature_planes, config["conv"], config["fc1"], momentum=config["momentum"],
                                fold_number=None, gain=config["gain"], model_prefix="final_")
+        net.histogram_writer = self.histogram_writer
+        net.checkpoint_manager = self.checkpoint_manager
 
         if torch.cuda.is_available():
             net.cuda()
             self.loss_func.cuda()
-        big_train_set = IcebergDataset("../data/all.npy", transform=transformations, top=self.train_top,
-                                       add_feature_planes="no")
-        val_ds = IcebergDataset("../data/folds/test_3.npy", transform=ToTensor(),
-                                top=self.test_top, add_feature_planes="no")
+        _, val_indices = load_fold(self.folds_path, 3)
+        train_loader, val_loader = self._get_loaders(config, transformations, None, val_indices)
+
+        optim = torch.optim.Adam(net.parameters(), lr=config["lr"], weight_decay=config["lambda"])
+        try:
+            best = net.fit(optim, self.loss_func, train_loader, val_loader, epochs, logger=main_logger)
+        finally:
+            _close_loaders(train_loader, val_loader)
+            main_logger.close()
+        print()
+        print("Best was ", best)
+        return best
+
+    def _train_fold(self, config, epochs, transformations, fold, start_epoch=0, checkpoint=None,
+                    epoch_callback=None):
+        """
+        :param checkpoint: path to model saved after `start_epoch` epochs, training continues from it
+        :param epoch_callback: see BaseBinaryClassifier.fit
+        """
+        main_logger = self.logger_class("../logs/%s" % fold, erase_folder_content=start_epoch == 0)
+
+        model_prefix = config_fingerprint(config)
+        net = self.model_class(self.num_feature_planes, config["conv"], config["fc1"],
+                               momentum=config["momentum"], fold_number=fold, gain=config["gain"],
+                               model_prefix=model_prefix)
+        net.histogram_writer = self.histogram_writer
+        net.checkpoint_manager = self.checkpoint_manager
 
-        train_loader = DataLoader(big_train_set, batch_size=config["train_batch_size"], num_workers=12,
-                                  pin_memory=True, shuffle=True)
-        val_loader = DataLoader(val_ds, batch_size=config["test_batch_size"], num_workers=6, pin_memory=True)
+        if torch.cuda.is_available():
+            net.cuda()
+            self.loss_func.cuda()
+        train_indices, val_indices = load_fold(self.folds_path, fold)
+        train_loader, val_loader = self._get_loaders(config, transformations, train_indices, val_indices)
 
         optim = torch.optim.Adam(net.parameters(), lr=config["lr"], weight_decay=config["lambda"])
-        best = net.fit(optim, self.loss_func, train_loader, val_loader, epochs, logger=main_logger)
+        try:
+            if checkpoint is not None:
+                net.load(checkpoint, optim)
+            best = net.fit(optim, self.loss_func, train_loader, val_loader, epochs, logger=main_logger,
+                           start_epoch=start_epoch, epoch_callback=self._get_stop_callback(epoch_callback))
+        finally:
+            _close_loaders(train_loader, val_loader)
+            main_logger.close()
         print()
         print("Best was ", best)
         return best
 
-    def train_one_configuration(self, config, epochs, transformations):
+    def _train_folds_parallel(self, config, epochs, transformations, workers):
+        """
+        Train every fold in its own process, at most `workers` of them at once.
+        CPU cores are split between workers. Cores of one worker are split between its torch threads and
+        DataLoader processes (half of them each), so all processes together use about as many cores as there are.
+        In memory loaders do not start processes, then all cores of worker go to torch.
+        Workers ignore SIGINT. On signal during search they stop after the current epoch and are waited for,
+        on failure of one of them the others are terminated
+        """
+        cores = max((os.cpu_count() or 1) // workers, 1)
+        loader_workers = 0 if self.in_memory else cores // 2
+        threads = max(cores - loader_workers, 1)
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        pending = list(range(self.num_folds))
+        running = {}
+        scores = {}
+        try:
+            while pending or running:
+                while pending and len(running) < workers:
+                    fold = pending.pop(0)
+                    process = context.Process(target=_fold_worker,
+                                              args=(self, config, epochs, transformations, fold, threads,
+                                                    loader_workers, results))
+                    with ignoring_sigint():
+                        process.start()
+                    running[fold] = process
+                try:
+                    fold, best = results.get(timeout=1)
+                    scores[fold] = best
+                    running.pop(fold).join()
+                except queue.Empty:
+                    for fold, process in running.items():
+                        # worker which died while search stops is not a failure, trial is released and repeated
+                        if not process.is_alive() and process.exitcode != 0 and not self._kill:
+                            raise ProjectException("Worker of fold %s failed with exit code %s"
+                                                   % (fold, process.exitcode))
+                if self._kill:
+                    print("Stopping fold workers because of signal!")
+                    break
+        finally:
+            for process in running.values():
+                if not self._kill:
+                    process.terminate()
+                process.join()
+        return [scores[f] for f in sorted(scores)]
+
+    def _train_folds_stacked(self, config, epochs, transformations, start_epoch=0, checkpoints=None,
+                             epoch_callbacks=None):
+        """
+        Train models of all folds together in one batched forward / backward pass, see ModelStack.
+        Checkpoints and logs of every fold are the same as of _train_fold.
+        Training stops after the current epoch on signal during search
+        :param checkpoints: paths to fold models saved after `start_epoch` epochs, training continues from them
+        :param epoch_callbacks: callbacks of folds, see ModelStack.fit
+        """
+        model_prefix = config_fingerprint(config)
+        models, optimizers, loggers, train_loaders, val_loaders = [], [], [], [], []
+        for fold in range(self.num_folds):
+            net = self.model_class(self.num_feature_planes, config["conv"], config["fc1"],
+                                   momentum=config["momentum"], fold_number=fold, gain=config["gain"],
+                                   model_prefix=model_prefix)
+            net.histogram_writer = self.histogram_writer
+            net.checkpoint_manager = self.checkpoint_manager
+            if torch.cuda.is_available():
+                net.cuda()
+            train_indices, val_indices = load_fold(self.folds_path, fold)
+            train_loader, val_loader = self._get_loaders(config, transformations, train_indices, val_indices)
+            optim = torch.optim.Adam(net.parameters(), lr=config["lr"], weight_decay=config["lambda"])
+            if checkpoints is not None:
+                net.load(checkpoints[fold], optim)
+            models.append(net)
+            optimizers.append(optim)
+            loggers.append(self.logger_class("../logs/%s" % fold, erase_folder_content=start_epoch == 0))
+            train_loaders.append(train_loader)
+            val_loaders.append(val_loader)
+        if torch.cuda.is_available():
+            self.loss_func.cuda()
+        callbacks = epoch_callbacks or [None] * self.num_folds
+        callbacks = [self._get_stop_callback(callback) for callback in callbacks]
+        try:
+            best = ModelStack(models).fit(optimizers, self.loss_func, train_loaders, val_loaders, epochs, loggers,
+                                          start_epoch=start_epoch, epoch_callback=callbacks)
+        finally:
+            _close_loaders(*(train_loaders + val_loaders))
+            for logger in loggers:
+                logger.close()
+        print()
+        print("Best were ", best)
+        return best
+
+    def _get_stop_callback(self, epoch_callback=None):
+        # stops model after epoch on signal, then asks wrapped callback
+        def callback(model, optim, epoch, stats):
+            if self._kill:
+                return False
+            return epoch_callback is None or epoch_callback(model, optim, epoch, stats) is not False
+        return callback
+
+    def train_one_configuration(self, config, epochs, transformations, workers=1, stacked=False):
+        """
+        :param workers: number of folds trained in parallel processes, folds are trained one by one if 1
+        :param stacked: train all folds at once in one process, see ModelStack
+        :return: list of best validation losses of folds
+        """
         assert "gain" in config
         assert "conv" in config
         assert "lr" in config
@@ -85,60 +295,61 @@ class ModelTrainer:
         assert "train_batch_size" in config
         assert "test_batch_size" in config
 
+        if stacked:
+            return self._train_folds_stacked(config, epochs, transformations)
+        if workers > 1:
+            return self._train_folds_parallel(config, epochs, transformations, workers)
         scores = []
-
         for f in range(self.num_folds):
-            main_logger = self.logger_class("../logs/%s" % f, erase_folder_content=True)
+            if self._kill:
+                break
+            scores.append(self._train_fold(config, epochs, transformations, f))
+        return scores
 
-            model_prefix = str(hash(str(config)))
-            net = self.model_class(self.num_feature_planes, config["conv"], config["fc1"],
-                                   momentum=config["momentum"], fold_number=f, gain=config["gain"],
-                                   model_prefix=model_prefix)
+    def random_search(self, iterations, config, train_epochs, transformations, verbose=True,
+                      result_path="../data/results.csv", workers=1, fold_workers=1,
+                      journal_path="../data/search/trials.jsonl"):
+        """
+        Random search over grid `config`. Trials are recorded in journal, so interrupted search is resumed
+        by calling this method again with the same journal
+        :param workers: number of local processes running trials
+        :param fold_workers: number of processes training folds of one trial
+        """
+        search = RandomSearch(self, config, journal_path=journal_path)
+        all_scores = search.run(iterations, train_epochs, transformations, workers=workers,
+                                fold_workers=fold_workers, result_path=result_path)
+        if verbose:
+            print(all_scores)
+        return all_scores
 
-            if torch.cuda.is_available():
-                net.cuda()
-                self.loss_func.cuda()
-            train_set = IcebergDataset("../data/folds/train_%s.npy" % f, transform=transformations,
-                                       top=self.train_top, add_feature_planes="no")
+    def asha_search(self, max_trials, config, transformations, min_epochs=5, max_epochs=100, reduction_factor=3,
+                    result_path="../data/asha_results.csv", checkpoint_directory="../models/asha", stacked=False):
+        """
+        Search over grid `config` with asynchronous successive halving, see ASHAScheduler.
+        Poor configurations are stopped after `min_epochs`, only the best ones are trained for `max_epochs`
+        :param stacked: train all folds of configuration at once, see ModelStack
+        """
+        search = ASHAScheduler(self, config, min_epochs=min_epochs, max_epochs=max_epochs,
+                               reduction_factor=reduction_factor, checkpoint_directory=checkpoint_directory,
+                               stacked=stacked)
+        return search.run(max_trials, transformations, result_path=result_path)
 
-            val_ds = IcebergDataset("../data/folds/test_%s.npy" % f, transform=ToTensor(),
-                                    top=self.test_top, add_feature_planes="no")
 
-            train_loader = DataLoader(train_set, batch_size=config["train_batch_size"], num_workers=12,
-                                      pin_memory=True, shuffle=True)
-            val_loader = DataLoader(val_ds, batch_size=config["test_batch_size"], num_workers=6, pin_memory=True)
+def _close_loaders(*loaders):
+    # shared memory of datasets is released as soon as configuration is trained, not at exit of search
+    for loader in loaders:
+        dataset = getattr(loader, "dataset", None)
+        if hasattr(dataset, "close"):
+            dataset.close()
 
-            optim = torch.optim.Adam(net.parameters(), lr=config["lr"], weight_decay=config["lambda"])
-            best = net.fit(optim, self.loss_func, train_loader, val_loader, epochs, logger=main_logger)
-            print()
-            print("Best was ", best)
-            scores.append(best)
-        return scores
 
-    @classmethod
-    def _save_results(cls, data, path):
-        results = pd.DataFrame(data)
-        results.to_csv(path, index=False)
-        print("Results are saved to path %s" % path)
-
-    def random_search(self, iterations, config, train_epochs, transformations,
-                      verbose=True, result_path="../data/results.csv"):
-        self._searching = True
-        all_scores = []
-        for _ in progressbar(range(iterations)):
-            if self._kill:
-                print("Will exit now because of signal!")
-                break
-            current_config = self._get_random_config(config)
-            current_score = self.train_one_configuration(current_config, train_epochs, transformations)
-
-            current_score.extend([str(current_config), str(hash(str(current_config)))])
-            all_scores.append(current_score)
-            if verbose:
-                print(all_scores)
-        self._save_results(all_scores, result_path)
-        self._searching = False
-        return all_scores
+def _fold_worker(trainer, config, epochs, transformations, fold, threads, loader_workers, results):
+    # Ctrl+C is delivered to the whole process group, only main process handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    torch.set_num_threads(threads)
+    trainer.num_workers = loader_workers
+    best = trainer._train_fold(config, epochs, transformations, fold)
+    results.put((fold, best))
 
 
 def _train_classifiers():
@@ -169,20 +380,15 @@ def _train_classifiers():
     val_top = None
     num_planes = 2
 
-    one_transform = transforms.Compose(
-        [
-            Flip(axis=2, rnd=True),
-            Flip(axis=1, rnd=True),
-            Rotate(90, rnd=True),
-            Rotate(180, rnd=True),
-            ToTensor()
-        ]
-    )
+    # flips and rotations are applied to collated batches, see BatchDihedral
+    one_transform = ToTensor()
 
     loss_func = nn.BCELoss()
 
-    trainer = ModelTrainer(num_planes, LeNet, loss_func, n_folds, Logger, train_top=top, test_top=val_top)
+    trainer = ModelTrainer(num_planes, LeNet, loss_func, n_folds, Logger, train_top=top, test_top=val_top,
+                           batch_transform=BatchDihedral(), in_memory=True)
     # loss_scores = trainer.random_search(100, parameter_grid, train_epochs=100, transformations=one_transform)
+    # loss_scores = trainer.asha_search(100, parameter_grid, one_transform, min_epochs=4, max_epochs=100)
     # loss_scores = trainer.train_one_configuration(best_config, 100, one_transform)
     loss_scores = trainer.train_all(best_config, 100, one_transform)
     print(loss_scores)
@@ -213,14 +419,14 @@ def _train_auto_encoders():
 
     one_transform = transforms.Compose(
         [
-            Flip(axis=2, targets_also=True, rnd=True),
-            Flip(axis=1, targets_also=True, rnd=True),
-            Rotate(90, targets_also=True, rnd=True),
-            Rotate(180, targets_also=True, rnd=True),
             Ravel(),
             ToTensor()
         ]
     )
+    shape = (num_planes, 75, 75)
+    # noise is added to collated batches, items carry only per image noise params
+    train_collate = BatchCollate(BatchDihedral(targets_also=True, shape=shape), BatchNoise(shape=shape))
+    val_collate = BatchCollate(BatchNoise(shape=shape, seed=10101))
     val_transform = transforms.Compose([
         Ravel(),
         ToTensor()
@@ -228,16 +434,21 @@ def _train_auto_encoders():
 
     for f in range(n_folds):
         main_logger = Logger("../logs/enc/", erase_folder_content=False)
-        train_set = AutoEncoderDataset("../data/all.npy", transform=one_transform, top=top)
-        train_loader = DataLoader(train_set, batch_size=train_bsize, num_workers=12, pin_memory=True, shuffle=True)
-        val_set = AutoEncoderDataset("../data/folds/test_1.npy", transform=val_transform, top=val_top)
-        val_loader = DataLoader(val_set, batch_size=test_b_size, num_workers=6, pin_memory=True)
+        _, val_indices = load_fold("../data/folds", 1)
+        train_set = AutoEncoderDataset("../data/store/train", transform=one_transform, top=top, batch_noise=True)
+        train_loader = DataLoader(train_set, batch_size=train_bsize, num_workers=12, pin_memory=True, shuffle=True,
+                                  collate_fn=train_collate, worker_init_fn=seed_worker)
+        val_set = AutoEncoderDataset("../data/store/train", transform=val_transform, top=val_top,
+                                     indices=val_indices, batch_noise=True)
+        val_loader = DataLoader(val_set, batch_size=test_b_size, num_workers=6, pin_memory=True,
+                                collate_fn=val_collate, worker_init_fn=seed_worker)
 
         encoder = VariationalAutoEncoder(num_planes, fold_number=None)
         if torch.cuda.is_available():
             encoder.cuda()
         optim = torch.optim.Adam(encoder.parameters(), lr=0.001, weight_decay=0)
         best = encoder.fit(optim, loss_function, train_loader, val_loader, 100, logger=main_logger)
+        main_logger.close()
         scores.append(best)
         print()
         print("Best was ", best)
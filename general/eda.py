@@ -80,7 +80,7 @@ def get_best_clusters(x):
 
 
 def inspect_angle():
-    data = IcebergDataset("../data/all.npy", return_angle=True, mu_sigma=None)
+    data = IcebergDataset("../data/store/train", return_angle=True, mu_sigma=None)
     result = []
     for el in data:
         image = el["inputs"]
@@ -3,6 +3,7 @@ import numpy as np
 from sklearn.model_selection import StratifiedKFold
 from sklearn.metrics import log_loss, accuracy_score
 from xgboost import XGBClassifier
+from cnn.store import read_ids
 
 
 data = pd.read_csv("../data/stats.csv", na_values="na")
@@ -42,10 +43,11 @@ def infer(mdls, dt):
 
 
 def get_data_frame(predictions, is_test=False):
+    # ids are streamed from json, bands are never loaded
     if is_test:
-        target_id = pd.read_json("../data/orig/test.json").as_matrix(["id"])
+        target_id = read_ids("../data/orig/test.json").astype(object)
     else:
-        target_id = pd.read_json("../data/orig/train.json").as_matrix(["id"])
+        target_id = read_ids("../data/orig/train.json").astype(object)
     final = np.column_stack((target_id, predictions))
     csv = pd.DataFrame(final, columns=["id", "is_iceberg"])
     return csv
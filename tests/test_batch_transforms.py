@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+import torch
+from scipy import ndimage
+from cnn.batch_transforms import BatchRotate
+
+ANGLES = [-180.0, -150.0, -135.0, -120.0, -90.0, -60.0, -45.0, -30.0, -17.5, 0.5, 12.0, 30.0, 45.0, 60.0,
+          90.0, 120.0, 135.0, 150.0, 179.0]
+
+
+@pytest.mark.parametrize("shape", [(75, 75), (74, 76)])
+@pytest.mark.parametrize("mode, order", [("nearest", 0), ("bilinear", 1)])
+def test_rotate_matches_ndimage(shape, mode, order):
+    images = np.random.RandomState(0).randn(2, 3, *shape).astype(np.float32)
+    for angle in ANGLES:
+        expected = ndimage.rotate(images, angle, axes=(3, 2), reshape=False, order=order, mode="nearest")
+        result = BatchRotate.rotate(torch.from_numpy(images), angle, mode).numpy()
+        np.testing.assert_allclose(result, expected, atol=1e-5, err_msg="angle %s" % angle)
+
+
+def test_apply_rotates_every_sample_by_its_angle():
+    images = torch.randn(4, 2, 75, 75)
+    angles = torch.tensor([0.0, -120.0, 30.0, -120.0])
+    result = BatchRotate.apply(images, (angles, "nearest"))
+    assert torch.equal(result[0], images[0])
+    for i in range(1, 4):
+        expected = ndimage.rotate(images[i].numpy(), angles[i].item(), axes=(2, 1), reshape=False, order=0,
+                                  mode="nearest")
+        np.testing.assert_array_equal(result[i].numpy(), expected)
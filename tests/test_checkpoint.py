@@ -0,0 +1,33 @@
+import os
+import torch
+from base.checkpoint import CheckpointManager, write_checkpoint, link_checkpoint
+
+
+def _checkpoint(val_loss):
+    return {"state_dict": {"weight": torch.full((2,), val_loss)}, "scores": {"val_loss": val_loss}}
+
+
+def test_synchronous_save_after_managed_save_keeps_best(tmp_path):
+    path, best_path = str(tmp_path / "epoch.mdl"), str(tmp_path / "best.mdl")
+    manager = CheckpointManager(keep=1)
+    manager.save(_checkpoint(0.5), path, group="fold", best_path=best_path)
+    manager.flush()
+
+    # the same steps as BaseModel.save of a worse epoch, then of a better one
+    write_checkpoint(_checkpoint(0.9), path)
+    assert torch.load(best_path)["scores"]["val_loss"] == 0.5
+    write_checkpoint(_checkpoint(0.3), path)
+    link_checkpoint(path, best_path)
+    assert torch.load(best_path)["scores"]["val_loss"] == 0.3
+    assert torch.load(path)["scores"]["val_loss"] == 0.3
+
+
+def test_manager_keeps_best_checkpoints_of_group(tmp_path):
+    manager = CheckpointManager(keep=2)
+    paths = [str(tmp_path / ("epoch_%s.mdl" % i)) for i in range(4)]
+    best_path = str(tmp_path / "best.mdl")
+    for path, val_loss in zip(paths, [0.7, 0.4, 0.9, 0.5]):
+        manager.save(_checkpoint(val_loss), path, group="fold", best_path=best_path)
+    manager.flush()
+    assert [os.path.isfile(path) for path in paths] == [False, True, False, True]
+    assert torch.load(best_path)["scores"]["val_loss"] == 0.4
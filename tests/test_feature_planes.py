@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from scipy import ndimage, signal
+from cnn.feature_planes import autocorrelate, median_filter_3x3
+
+
+@pytest.mark.parametrize("shape", [(75, 75), (74, 76), (75, 76), (74, 75), (8, 9)])
+def test_autocorrelate_matches_signal_correlate(shape):
+    images = np.random.RandomState(0).randn(4, *shape).astype(np.float32)
+    expected = np.stack([signal.correlate(image, image, mode="same") for image in images])
+    result = autocorrelate(images)
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-2)
+
+
+@pytest.mark.parametrize("shape", [(75, 75), (74, 76)])
+def test_median_filter_matches_ndimage(shape):
+    images = np.random.RandomState(0).randn(3, 2, *shape).astype(np.float32)
+    expected = ndimage.median_filter(images, size=(1, 1, 3, 3))
+    np.testing.assert_array_equal(median_filter_3x3(images), expected)
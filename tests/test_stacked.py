@@ -0,0 +1,38 @@
+import copy
+import torch
+import torch.nn as nn
+from base.stacked import stacked_batch_norm
+
+
+def _norms(num_models=2, channels=3):
+    torch.manual_seed(0)
+    norms = [nn.BatchNorm2d(channels, momentum=0.1 * (k + 1)) for k in range(num_models)]
+    for norm in norms:
+        nn.init.normal_(norm.weight)
+        nn.init.normal_(norm.bias)
+    return norms
+
+
+def test_padded_rows_do_not_change_batch_statistics():
+    sizes = [4, 2]
+    batches = [torch.randn(rows, 3, 5, 5, requires_grad=True) for rows in sizes]
+    norms = _norms()
+    expected_norms = copy.deepcopy(norms)
+    expected = [norm(batch) for norm, batch in zip(expected_norms, batches)]
+    sum(e.sum() * (k + 1) for k, e in enumerate(expected)).backward()
+    expected_grads = [b.grad.clone() for b in batches]
+
+    for batch in batches:
+        batch.grad = None
+    # the second batch is padded by repeating its rows, as ModelStack._get_inputs does
+    padded = [batches[0], batches[1][torch.arange(4) % 2]]
+    out = stacked_batch_norm(torch.cat(padded, dim=1), norms, sizes)
+    result = [out[:rows, k * 3: (k + 1) * 3] for k, rows in enumerate(sizes)]
+    sum(r.sum() * (k + 1) for k, r in enumerate(result)).backward()
+
+    for k in range(2):
+        torch.testing.assert_close(result[k], expected[k])
+        torch.testing.assert_close(batches[k].grad, expected_grads[k])
+        torch.testing.assert_close(norms[k].running_mean, expected_norms[k].running_mean)
+        torch.testing.assert_close(norms[k].running_var, expected_norms[k].running_var)
+        torch.testing.assert_close(norms[k].weight.grad, expected_norms[k].weight.grad)
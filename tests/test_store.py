@@ -0,0 +1,91 @@
+import os
+import json
+import errno
+import numpy as np
+import pytest
+from cnn import store as store_module
+from cnn.store import IcebergStore, convert, load_json, share_json
+
+
+def _make_store(length=3, width=4):
+    bands = np.random.RandomState(0).randn(length, 2, width, width).astype(np.float32)
+    angle = np.array([30.5, np.nan, 40.0], dtype=np.float32)[:length]
+    ids = np.array(["id%s" % i for i in range(length)], dtype=np.str_)
+    return IcebergStore(bands, angle, ids, labels=np.arange(length, dtype=np.float32) % 2)
+
+
+@pytest.fixture
+def shared_memory(tmp_path, monkeypatch):
+    directory = tmp_path / "shm"
+    directory.mkdir()
+    monkeypatch.setattr(store_module, "SHARED_MEMORY", str(directory))
+    monkeypatch.setattr(store_module.tempfile, "tempdir", str(tmp_path / "tmp"))
+    (tmp_path / "tmp").mkdir()
+    return str(directory)
+
+
+def test_share_uses_shared_memory_with_room(shared_memory, monkeypatch):
+    monkeypatch.setattr(store_module, "SHARED_MEMORY_RESERVE", 0)
+    with _make_store().share() as shared:
+        assert os.path.dirname(shared.directory) == shared_memory
+        np.testing.assert_array_equal(shared.bands, _make_store().bands)
+    assert not os.path.exists(shared.directory)
+
+
+def test_share_falls_back_to_disk_without_room(shared_memory, monkeypatch):
+    # reserve of shared memory is larger than free space of the test file system
+    monkeypatch.setattr(store_module, "SHARED_MEMORY_RESERVE", 1 << 60)
+    with _make_store().share() as shared:
+        assert os.path.dirname(shared.directory) != shared_memory
+
+
+def test_share_falls_back_to_disk_on_enospc(shared_memory, monkeypatch):
+    monkeypatch.setattr(store_module, "SHARED_MEMORY_RESERVE", 0)
+    save = IcebergStore.save
+
+    def full_shared_memory(self, directory):
+        if directory.startswith(shared_memory):
+            raise OSError(errno.ENOSPC, "No space left on device")
+        return save(self, directory)
+
+    monkeypatch.setattr(IcebergStore, "save", full_shared_memory)
+    with _make_store().share() as shared:
+        assert os.path.dirname(shared.directory) != shared_memory
+        np.testing.assert_array_equal(shared.ids, _make_store().ids)
+    assert os.listdir(shared_memory) == []
+
+
+def _write_json(path, length=3, width=4):
+    data = _make_store(length, width)
+    records = []
+    for i in range(length):
+        angle = "na" if np.isnan(data.angle[i]) else float(data.angle[i])
+        records.append({"id": str(data.ids[i]), "band_1": data.bands[i, 0].ravel().tolist(),
+                        "band_2": data.bands[i, 1].ravel().tolist(), "inc_angle": angle,
+                        "is_iceberg": int(data.labels[i])})
+    with open(path, "w") as f:
+        json.dump(records, f)
+    return data
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 512])
+def test_share_json_matches_json(shared_memory, tmp_path, monkeypatch, chunk_size):
+    monkeypatch.setattr(store_module, "SHARED_MEMORY_RESERVE", 0)
+    path = str(tmp_path / "train.json")
+    expected = _write_json(path)
+    with share_json(path, width=4, chunk_size=chunk_size) as shared:
+        assert os.path.dirname(shared.directory) == shared_memory
+        for name in ("bands", "angle", "angle_mask", "ids", "labels"):
+            np.testing.assert_array_equal(getattr(shared, name), getattr(expected, name))
+            np.testing.assert_array_equal(getattr(shared, name), getattr(load_json(path, width=4), name))
+    assert os.listdir(shared_memory) == []
+
+
+def test_convert_writes_store(tmp_path):
+    path = str(tmp_path / "train.json")
+    expected = _write_json(path)
+    converted = convert(path, str(tmp_path / "store"), width=4, chunk_size=2)
+    np.testing.assert_array_equal(converted.bands, expected.bands)
+    np.testing.assert_array_equal(converted.labels, expected.labels)
+    assert sorted(os.listdir(str(tmp_path / "store"))) == ["angle.npy", "angle_mask.npy", "bands.npy", "ids.npy",
+                                                           "labels.npy"]